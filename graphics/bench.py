@@ -0,0 +1,160 @@
+import subprocess
+import sys
+from timeit import default_timer
+
+import numba
+import numpy as np
+
+from . import utils
+from .colors import affine_spaces, convert_color
+from .dither import algos, atkinson_dither, floyd_dither
+from .palette import map_to_palette
+from .reference import hsx_conversions, hsx_test_image, precision_stages
+from .utils import set_precision
+
+rng = np.random.default_rng(0)
+
+
+def timed(f, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        start = default_timer()
+        result = f(*args, **kwargs)
+        best = min(best, default_timer() - start)
+    return best, result
+
+
+def report(label, new_name, new_time, old_name, old_time):
+    print(
+        f"{label:>24} {new_name} {new_time * 1000:8.1f} ms, {old_name} {old_time * 1000:8.1f} ms,"
+        f" x{old_time / new_time:.1f}"
+    )
+
+
+def legacy_convert_color(image, frm, to):
+    # the old path: through a full rgb image, one einsum per step
+    if frm != "rgb":
+        mat, offset = affine_spaces[frm]
+        image = np.einsum("ij,mnj->mni", np.linalg.inv(mat), image - offset)
+    if to != "rgb":
+        mat, offset = affine_spaces[to]
+        image = np.einsum("ij,mnj->mni", mat, image) + offset
+    return image
+
+
+def bench_hsx(shape):
+    image = hsx_test_image(shape)
+    out = np.empty_like(image)
+    print(f"hsl/hsv on {shape[1]}x{shape[0]}:")
+    for name, new_f, old_f in hsx_conversions:
+        new_f(image[:1, :1])  # warm up the jit
+        old_time, _ = timed(old_f, image)
+        new_time, _ = timed(new_f, image, out=out)
+        report(name, "compiled", new_time, "masks", old_time)
+
+
+def bench_convert_color(shape, pairs):
+    image = rng.random(shape)
+    out = np.empty_like(image)
+    print(f"convert_color on {shape[1]}x{shape[0]}:")
+    for frm, to in pairs:
+        old_time, old = timed(legacy_convert_color, image, frm, to)
+        new_time, new = timed(convert_color, image, frm, to, out=out)
+        assert np.allclose(old, new)
+        report(f"{frm} -> {to}", "fused", new_time, "via rgb", old_time)
+
+
+def in_precision(dtype, f, *args):
+    previous = utils.precision
+    set_precision(dtype)
+    try:
+        return timed(f, *args)
+    finally:
+        set_precision(previous)
+
+
+def bench_precision(shape, max_val=65535):
+    # the error bounds against float64 are checked in tests/test_precision.py
+    raw = rng.integers(0, max_val + 1, shape, dtype=np.uint16)
+    single_time, _ = in_precision(np.float32, precision_stages, raw, max_val)
+    double_time, _ = in_precision(np.float64, precision_stages, raw, max_val)
+    print(f"float32 against float64 on {shape[1]}x{shape[0]}:")
+    report("all stages", "float32", single_time, "float64", double_time)
+
+
+def bench_wavefront(shape, bitness=1):
+    image = rng.random(shape).astype(np.float32)
+    threads = numba.config.NUMBA_NUM_THREADS
+    print(f"error diffusion on {shape[1]}x{shape[0]}, 1 to {threads} threads:")
+    for name, dither in [("floyd", floyd_dither), ("atkinson", atkinson_dither)]:
+        dither(image[:8, :8], bitness, parallel=False)  # warm up the jit
+        dither(image[:8, :8], bitness, parallel=True)
+        serial_time, serial = timed(dither, image, bitness, parallel=False)
+        for n in range(1, threads + 1):
+            numba.set_num_threads(n)
+            parallel_time, parallel = timed(dither, image, bitness, parallel=True)
+            assert np.array_equal(serial, parallel)
+            report(f"{name}, {n} threads", "wavefront", parallel_time, "serial", serial_time)
+        numba.set_num_threads(threads)
+
+
+def bench_palette(shape, colors=64):
+    image = rng.random(shape).astype(np.float32)
+    palette = rng.random((colors, 3))
+    # the grid lookup has to give exactly the brute force nearest color, also outside the cube
+    pixels = rng.uniform(-0.25, 1.25, (100_000, 1, 3))
+    brute = palette[np.argmin(((pixels - palette) ** 2).sum(axis=-1), axis=1)]
+    assert np.array_equal(map_to_palette(pixels, palette)[:, 0], brute)
+    print(f"dithering to {colors} colors on {shape[1]}x{shape[0]}:")
+    for name in ["floyd", "ordered"]:
+        algos[name](image[:8, :8], 1, palette=palette)  # warm up the jit and build the index
+        grid_time, _ = timed(algos[name], image, 1)
+        palette_time, _ = timed(algos[name], image, 1, palette=palette)
+        report(name, "palette", palette_time, "grid", grid_time)
+
+
+STARTUP_MODULES = ["graphics", "graphics.dither", "graphics.pipeline", "graphics.png", "graphics.render"]
+STARTUP_BUDGET = 0.5
+FIRST_CALL = "graphics.dither.floyd_dither(numpy.zeros((4, 4, 3), numpy.float32), 1)"
+
+
+def fresh_process(statement, setup="pass", repeat=3):
+    """Best wall time of `statement` in a new interpreter, and whether numba got imported by it."""
+    script = (
+        "import sys, time\n"
+        f"{setup}\n"
+        "start = time.perf_counter()\n"
+        f"{statement}\n"
+        "print(time.perf_counter() - start, 'numba' in sys.modules)"
+    )
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        elapsed, numba_loaded = out.split()
+        runs.append((float(elapsed), numba_loaded == "True"))
+    return min(runs)
+
+
+def bench_startup(budget=STARTUP_BUDGET):
+    """Fails when importing the package gets slower than `budget` seconds or pulls in numba again."""
+    import_time, numba_loaded = fresh_process(f"import {', '.join(STARTUP_MODULES)}")
+    first_call, _ = fresh_process(FIRST_CALL, setup=f"import numpy, {', '.join(STARTUP_MODULES)}")
+    print("startup:")
+    print(f"{'import':>24} {import_time * 1000:8.1f} ms, budget {budget * 1000:.0f} ms")
+    print(f"{'first kernel call':>24} {first_call * 1000:8.1f} ms (run graphics.warmup to fill the cache)")
+    if numba_loaded:
+        raise SystemExit("startup regressed: importing the package imports numba")
+    if import_time > budget:
+        raise SystemExit(f"startup regressed: import took {import_time:.2f} s, budget {budget:.2f} s")
+
+
+if __name__ == "__main__":
+    bench_startup()
+    bench_convert_color(
+        (3000, 4000, 3),
+        [("rgb", "ypbpr601"), ("ypbpr601", "ycocg"), ("ycocg", "cmy"), ("cmy", "ypbpr709")],
+    )
+    bench_hsx((3000, 4000, 3))
+    bench_precision((3000, 4000, 3))
+    bench_wavefront((3000, 4000, 3))
+    bench_palette((3000, 4000, 3))
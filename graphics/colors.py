@@ -1,88 +1,125 @@
-from functools import wraps
+import weakref
+from collections import OrderedDict
+from functools import cache, lru_cache
+from itertools import count
 
 import numpy as np
 
-color_modes = ["rgb", "hsl", "hsv", "ypbpr601", "ypbpr709", "ycocg", "cmy"]
-
-
-def get_h(image, c_max, c_delta, out):
-    has_delta = c_delta != 0
-    rmax = has_delta & (c_max == image[:, :, 0])
-    out[rmax] = (image[rmax, 1] - image[rmax, 2]) / c_delta[rmax]
-    gmax = has_delta & (c_max == image[:, :, 1])
-    out[gmax] = (image[gmax, 2] - image[gmax, 0]) / c_delta[gmax] + 2
-    bmax = has_delta & (c_max == image[:, :, 2])
-    out[bmax] = (image[bmax, 0] - image[bmax, 1]) / c_delta[bmax] + 4
-    out /= 6
-    out %= 1
-
+from .jit import njit, prange
+from .pnm.exceptions import DataError
+from .utils import SRGB, float_dtype, normalize, to_8bit
 
-def get_sl(c_max, c_sum, c_delta, out):
-    out[:, :, 1] = l = c_sum / 2
-    ok = (l != 0) & (l != 1)
-    out[ok, 0] = c_delta[ok] / (1 - np.abs(c_sum[ok] - 1))
-
-
-def get_sv(c_max, c_sum, c_delta, out):
-    out[:, :, 1] = v = c_max
-    ok = v != 0
-    out[ok, 0] = c_delta[ok] / v[ok]
+color_modes = ["rgb", "hsl", "hsv", "ypbpr601", "ypbpr709", "ycocg", "cmy"]
 
 
-def rgb_to_hsx(get_sx):
-    def convert(image):
-        new = np.zeros_like(image)
-        c_min, c_max = image.min(axis=2), image.max(axis=2)
-        c_sum, c_delta = c_max + c_min, c_max - c_min
-        get_h(image, c_max, c_delta, new[:, :, 0])
-        get_sx(c_max, c_sum, c_delta, new[:, :, 1:])
-        return new
+@njit(cache=True)
+def hue(r, g, b, c_max, c_delta):
+    if c_delta == 0:
+        return 0.0
+    if c_max == b:
+        h = (r - g) / c_delta + 4
+    elif c_max == g:
+        h = (b - r) / c_delta + 2
+    else:
+        h = (g - b) / c_delta
+    return h / 6 % 1
+
+
+@njit(parallel=True, cache=True)
+def rgb_to_hsl_kernel(image, out):
+    for i in prange(image.shape[0]):
+        for j in range(image.shape[1]):
+            r, g, b = image[i, j, 0], image[i, j, 1], image[i, j, 2]
+            c_max, c_min = max(r, g, b), min(r, g, b)
+            c_sum, c_delta = c_max + c_min, c_max - c_min
+            l = c_sum / 2
+            out[i, j, 0] = hue(r, g, b, c_max, c_delta)
+            out[i, j, 1] = c_delta / (1 - abs(c_sum - 1)) if l != 0 and l != 1 else 0
+            out[i, j, 2] = l
+
+
+@njit(parallel=True, cache=True)
+def rgb_to_hsv_kernel(image, out):
+    for i in prange(image.shape[0]):
+        for j in range(image.shape[1]):
+            r, g, b = image[i, j, 0], image[i, j, 1], image[i, j, 2]
+            c_max, c_min = max(r, g, b), min(r, g, b)
+            c_delta = c_max - c_min
+            out[i, j, 0] = hue(r, g, b, c_max, c_delta)
+            out[i, j, 1] = c_delta / c_max if c_max != 0 else 0
+            out[i, j, 2] = c_max
+
+
+@njit(parallel=True, cache=True)
+def hsl_to_rgb_kernel(image, out):
+    for i in prange(image.shape[0]):
+        for j in range(image.shape[1]):
+            h, s, l = image[i, j, 0], image[i, j, 1], image[i, j, 2]
+            alpha = s * min(l, 1 - l)
+            for c, n in enumerate((0, 8, 4)):
+                k = (n + h * 12) % 12
+                out[i, j, c] = l - alpha * max(-1, min(k - 3, 9 - k, 1))
+
+
+@njit(parallel=True, cache=True)
+def hsv_to_rgb_kernel(image, out):
+    for i in prange(image.shape[0]):
+        for j in range(image.shape[1]):
+            h, s, v = image[i, j, 0], image[i, j, 1], image[i, j, 2]
+            for c, n in enumerate((5, 3, 1)):
+                k = (n + h * 6) % 6
+                out[i, j, c] = v * (1 - s * max(0, min(k, 4 - k, 1)))
+
+
+def pixel_converter(kernel):
+    """Per-pixel conversion in a single compiled pass; `out` may be the input itself."""
+
+    def convert(image, out=None):
+        if out is None:
+            out = np.empty_like(image)
+        kernel(image, out)
+        return out
 
     return convert
 
 
-def hsl_to_rgb(image):
-    new = np.zeros_like(image)
-    alpha = image[:, :, 1] * np.minimum(image[:, :, 2], 1 - image[:, :, 2])
-    for i, n in enumerate([0, 8, 4]):
-        k = (n + image[:, :, 0] * 12) % 12
-        new[:, :, i] = image[:, :, 2] - alpha * np.maximum(-1, np.minimum(k - 3, np.minimum(9 - k, 1)))
-    return new
+rgb_to_hsl = pixel_converter(rgb_to_hsl_kernel)
+rgb_to_hsv = pixel_converter(rgb_to_hsv_kernel)
+hsl_to_rgb = pixel_converter(hsl_to_rgb_kernel)
+hsv_to_rgb = pixel_converter(hsv_to_rgb_kernel)
 
 
-def hsv_to_rgb(image):
-    new = np.zeros_like(image)
-    for i, n in enumerate([5, 3, 1]):
-        k = (n + image[:, :, 0] * 6) % 6
-        new[:, :, i] = image[:, :, 2] * (1 - image[:, :, 1] * np.maximum(0, np.minimum(k, np.minimum(4 - k, 1))))
-    return new
+def apply_affine(image, mat, offset=None, out=None):
+    """Applies `mat` (and `offset`) to every pixel as one BLAS matmul over a (h*w, 3) view."""
+    pixels = image.reshape(-1, 3)
+    if out is None:
+        out = np.empty(image.shape, float_dtype(image))
+    out_pixels = out.reshape(-1, 3)
+    if np.shares_memory(pixels, out_pixels):
+        pixels = pixels.copy()
+    # the matrix takes the precision of the output, so float32 images stay float32 throughout
+    np.matmul(pixels, mat.T.astype(out.dtype, copy=False), out=out_pixels)
+    if offset is not None:
+        out_pixels += offset
+    return out
 
 
-def mul_colors(mat, image):
-    return np.einsum("ij,mnj->mni", mat, image)
+def mul_colors(mat, image, out=None):
+    return apply_affine(image, mat, out=out)
 
 
 def make_ypbpr(kr, kg, kb):
-    there_mat = np.array(
+    return np.array(
         [
             [kr, kg, kb],
             [-kr / 2 / (1 - kb), -kg / 2 / (1 - kb), 1 / 2],
             [1 / 2, -kg / 2 / (1 - kr), -kb / 2 / (1 - kr)],
         ]
     )
-    back_mat = np.linalg.inv(there_mat)
 
-    def there(image):
-        return mul_colors(there_mat, image)
 
-    def back(image):
-        return mul_colors(back_mat, image)
-
-    return there, back
-
-
-rgb_to_ypbpr601, ypbpr601_to_rgb = make_ypbpr(0.299, 0.587, 0.114)
-rgb_to_ypbpr709, ypbpr709_to_rgb = make_ypbpr(0.2126, 0.7152, 0.0722)
+ypbpr601_mat = make_ypbpr(0.299, 0.587, 0.114)
+ypbpr709_mat = make_ypbpr(0.2126, 0.7152, 0.0722)
 
 ycocg_there_mat = np.array(
     [
@@ -91,24 +128,49 @@ ycocg_there_mat = np.array(
         [-1 / 4, 1 / 2, -1 / 4],
     ]
 )
-ycocg_back_mat = np.linalg.inv(ycocg_there_mat)
 
+# color spaces that are an affine map of rgb: (mat, offset) with space = mat @ rgb + offset
+affine_spaces = {
+    "rgb": (np.eye(3), np.zeros(3)),
+    "ypbpr601": (ypbpr601_mat, np.zeros(3)),
+    "ypbpr709": (ypbpr709_mat, np.zeros(3)),
+    "ycocg": (ycocg_there_mat, np.zeros(3)),
+    "cmy": (-np.eye(3), np.ones(3)),
+}
+
+
+@cache
+def affine_plan(frm, to):
+    """Composes frm -> rgb -> to into a single (mat, offset), or None if either space is not affine."""
+    if frm not in affine_spaces or to not in affine_spaces:
+        return None
+    frm_mat, frm_offset = affine_spaces[frm]
+    to_mat, to_offset = affine_spaces[to]
+    back_mat = np.linalg.inv(frm_mat)
+    mat = to_mat @ back_mat
+    offset = to_offset - mat @ frm_offset
+    return mat, offset if offset.any() else None
 
-def rgb_to_ycocg(image):
-    return mul_colors(ycocg_there_mat, image)
 
+def affine_converter(frm, to):
+    def convert(image, out=None):
+        return apply_affine(image, *affine_plan(frm, to), out=out)
+
+    return convert
 
-def ycocg_to_rgb(image):
-    return mul_colors(ycocg_back_mat, image)
 
+rgb_to_ypbpr601, ypbpr601_to_rgb = affine_converter("rgb", "ypbpr601"), affine_converter("ypbpr601", "rgb")
+rgb_to_ypbpr709, ypbpr709_to_rgb = affine_converter("rgb", "ypbpr709"), affine_converter("ypbpr709", "rgb")
+rgb_to_ycocg, ycocg_to_rgb = affine_converter("rgb", "ycocg"), affine_converter("ycocg", "rgb")
 
-def cmy(rgb):
-    return 1 - rgb
+
+def cmy(rgb, out=None):
+    return np.subtract(1, rgb, out=out)
 
 
 rgb_to = {
-    "hsl": rgb_to_hsx(get_sl),
-    "hsv": rgb_to_hsx(get_sv),
+    "hsl": rgb_to_hsl,
+    "hsv": rgb_to_hsv,
     "ypbpr601": rgb_to_ypbpr601,
     "ypbpr709": rgb_to_ypbpr709,
     "ycocg": rgb_to_ycocg,
@@ -125,35 +187,216 @@ to_rgb = {
 }
 
 
-def convert_color(image, frm, to):
+def convert_color(image, frm, to, out=None):
+    """Converts between color spaces. Pairs of affine spaces go through one composed matrix; only
+    hsl and hsv take the detour through a full rgb image."""
+    if frm == to:
+        # a round trip through rgb would lose the hue of grays and more in hsl and hsv
+        if out is None or out is image:
+            return image
+        np.copyto(out, image)
+        return out
+    plan = affine_plan(frm, to)
+    if plan is not None:
+        return apply_affine(image, *plan, out=out)
+    if frm not in affine_spaces:
+        image = to_rgb[frm](image, out=out if to == "rgb" else None)
+        frm = "rgb"
+    if to in affine_spaces:
+        return image if to == "rgb" else apply_affine(image, *affine_plan(frm, to), out=out)
     if frm != "rgb":
-        image = to_rgb[frm](image)
-    if to != "rgb":
-        image = rgb_to[to](image)
-    return image
+        image = apply_affine(image, *affine_plan(frm, "rgb"))
+    return rgb_to[to](image, out=out)
+
+
+def parse_gamma(text):
+    text = text.strip()
+    return SRGB if text.lower() == SRGB else float(text)
+
+
+def decode_gamma(image, gamma):
+    if gamma != SRGB:
+        return image**gamma
+    return np.where(image <= 0.04045, image / 12.92, ((image + 0.055) / 1.055) ** 2.4)
+
+
+def encode_gamma(linear, gamma):
+    if gamma != SRGB:
+        return linear ** (1 / gamma)
+    return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055)
+
+
+def apply_gamma(image, frm, to):
+    """Re-encodes `image` from gamma `frm` to gamma `to`; either may be SRGB for the piecewise sRGB curve."""
+    if SRGB not in (frm, to):
+        return image ** (frm / to)
+    return encode_gamma(decode_gamma(image, frm), to)
+
+
+# gamma pairs whose tables are kept: every gamma typed into the viewer makes a new pair, and a
+# table for 16-bit samples holds 65536 entries
+GAMMA_TABLES = 16
+
+
+@lru_cache(maxsize=GAMMA_TABLES)
+def gamma_table(frm, to, max_val, dtype):
+    """Lookup table of apply_gamma for every integer sample of depth `max_val`, computed in float64."""
+    return apply_gamma(np.arange(max_val + 1) / max_val, frm, to).astype(dtype)
+
+
+@njit(parallel=True, cache=True)
+def lookup_kernel(table, samples, out):
+    for i in prange(samples.shape[0]):
+        out[i] = table[samples[i]]
+
+
+def lookup(table, samples, out=None):
+    """`table[samples]`; samples outside the table raise DataError instead of being read past its end."""
+    if out is None:
+        out = np.empty(samples.shape, table.dtype)
+    if out.shape != samples.shape:
+        raise ValueError(f"lookup output of shape {out.shape} for samples of shape {samples.shape}")
+    # the kernel does no bounds checks, so samples above max_val (say from a corrupt file) are caught here
+    if samples.size and (samples.dtype.kind != "u" or np.iinfo(samples.dtype).max >= len(table)):
+        if samples.min() < 0 or samples.max() >= len(table):
+            raise DataError("sample above max_val")
+    if not samples.dtype.isnative or not samples.flags.c_contiguous or not out.flags.c_contiguous:
+        return np.take(table, samples, out=out)
+    lookup_kernel(table, samples.reshape(-1), out.reshape(-1))
+    return out
+
+
+def sizeof(value):
+    return memoryview(value).nbytes
+
+
+class ImageCache:
+    """LRU cache of derived image arrays (or other buffers), bounded by their total size in bytes.
+
+    Keys start with the id of the family of images the array belongs to, so everything derived
+    from an image is dropped once no image of its family is alive anymore.
+    """
+
+    def __init__(self, budget=1 << 30):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+        self.entries[key] = value
+        self.nbytes += sizeof(value)
+        self.evict()
+
+    def pop(self, key):
+        if key in self.entries:
+            self.nbytes -= sizeof(self.entries.pop(key))
+
+    def evict(self):
+        while self.nbytes > self.budget and self.entries:
+            _, value = self.entries.popitem(last=False)
+            self.nbytes -= sizeof(value)
+            self.evictions += 1
+
+    def resize(self, budget):
+        self.budget = budget
+        self.evict()
+
+    def discard(self, family_id):
+        for key in [key for key in self.entries if key[0] == family_id]:
+            self.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "nbytes": self.nbytes,
+            "budget": self.budget,
+        }
+
+
+image_cache = ImageCache()
+family_ids = count()
+
+
+class Family:
+    """Identifies an image and its gamma variants, which share cache entries."""
+
+    __slots__ = ("id", "__weakref__")
+
+    def __init__(self):
+        self.id = next(family_ids)
+        weakref.finalize(self, image_cache.discard, self.id)
 
 
 class Image:
-    def __init__(self, data, color_mode="rgb", gamma=2.2, parent=None):
-        self.data = data
+    def __init__(self, data, color_mode="rgb", gamma=2.2, parent=None, max_val=None):
+        # with max_val, data holds raw integer samples (possibly a memmap) that are only
+        # normalized once some view of the image is actually needed
+        self.raw = data
+        self.max_val = max_val
         self.color_mode = color_mode
         self.gamma = gamma
-        self.cache = {color_mode: data}
-        self.gamma_cache = parent.gamma_cache if parent else {}
-        self.gamma_cache[gamma] = self
+        self.family = parent.family if parent else Family()
+        self.parent = weakref.ref(parent) if parent else None
+
+    def cached(self, color_mode, compute):
+        return image_cache.get((self.family.id, self.gamma, color_mode), compute)
+
+    @property
+    def data(self):
+        if self.max_val is None:
+            return self.raw
+        return self.cached(self.color_mode, lambda: normalize(self.raw, self.max_val))
 
     def __getitem__(self, color_mode):
-        if color_mode not in self.cache:
-            self.cache[color_mode] = convert_color(self.data, self.color_mode, color_mode)
-            if color_mode == "rgb":
-                self.color_mode = "rgb"
-        return self.cache[color_mode]
+        if color_mode == self.color_mode:
+            return self.data
+        return self.cached(color_mode, lambda: convert_color(self.data, self.color_mode, color_mode))
 
     def convert_gamma(self, gamma):
-        if gamma not in self.gamma_cache:
-            return Image(self["rgb"] ** (self.gamma / gamma), gamma=gamma, parent=self)
-        return self.gamma_cache[gamma]
+        if gamma == self.gamma:
+            return self
+        # convert from the image this one was derived from while it is alive, not from a variant
+        source = self.parent() if self.parent else None
+        if source is None or source.family is not self.family:
+            source = self
+        if source.gamma == gamma:
+            return source
+        data = image_cache.get((self.family.id, gamma, "rgb"), lambda: source.gamma_converted(gamma))
+        return Image(data, gamma=gamma, parent=source)
+
+    def gamma_converted(self, gamma):
+        if self.max_val is not None and self.color_mode == "rgb" and self.raw.dtype.kind in "ui":
+            # integer samples can only take max_val + 1 values, so one table lookup replaces pow
+            return lookup(gamma_table(self.gamma, gamma, self.max_val, float_dtype(self.raw)), self.raw)
+        return apply_gamma(self["rgb"], self.gamma, gamma)
+
+    def to_8bit(self, color_mode):
+        if color_mode == self.color_mode and self.max_val is not None and self.raw.dtype.kind in "ui":
+            return to_8bit(self.raw, self.max_val)
+        return to_8bit(self[color_mode])
 
     def assign_gamma(self, gamma):
         self.gamma = gamma
-        self.gamma_cache = {gamma: self}
+        self.family = Family()
+        self.parent = None
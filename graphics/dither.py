@@ -1,18 +1,91 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from functools import cache, partial
-from itertools import product
 from math import ceil
+from pathlib import Path
 
 import numpy as np
-from numba import njit
 
-rng = np.random.default_rng()
+from .jit import get_num_threads, njit, prange
+from .palette import map_to_palette, nearest_color, no_palette, palette_index, palette_levels
+from .utils import blockwise_view
 
+PARALLEL_PIXELS = 1 << 18
+WAVEFRONT_BLOCK = 64
+NOISE_ROWS = 64
 
-def closest(c):
-    q = np.array([np.floor(c), np.ceil(c)]).T
-    lats = np.array(list(product(*q)), dtype=float)
-    dists = np.sum((lats - c[np.newaxis, :]) ** 2, axis=1)
-    return lats[np.argmin(dists)]
+
+def void_and_cluster(size, sigma=1.5, seed=0):
+    """Blue noise thresholds by Ulichney's void-and-cluster method, on a torus of `size` x `size`.
+
+    A sparse random pattern is first relaxed by moving its tightest cluster into its largest
+    void until that changes nothing. Its points are then ranked by taking out tightest clusters
+    one by one, and the remaining pixels by filling the largest voids. Past half the pixels
+    the largest void is also the tightest cluster of the zeros, so one loop covers both.
+    """
+    n = size * size
+    dist = np.minimum(np.arange(size), size - np.arange(size))
+    gauss = np.exp(-(dist[:, np.newaxis] ** 2 + dist**2) / (2 * sigma**2))
+    seed_rng = np.random.default_rng(seed)
+
+    def toggle(pattern, energy, i, value):
+        pattern.flat[i] = value
+        energy += (1 if value else -1) * np.roll(gauss, np.unravel_index(i, pattern.shape), (0, 1))
+
+    def tightest_cluster(pattern, energy):
+        return np.argmax(np.where(pattern, energy, -np.inf))
+
+    def largest_void(pattern, energy):
+        return np.argmin(np.where(pattern, np.inf, energy))
+
+    pattern = np.zeros((size, size), bool)
+    pattern.flat[seed_rng.choice(n, max(1, n // 10), replace=False)] = True
+    energy = np.real(np.fft.ifft2(np.fft.fft2(pattern) * np.fft.fft2(gauss)))
+    while True:
+        cluster = tightest_cluster(pattern, energy)
+        toggle(pattern, energy, cluster, False)
+        void = largest_void(pattern, energy)
+        toggle(pattern, energy, void, True)
+        if void == cluster:
+            break
+
+    ranks = np.empty(n, int)
+    ones = int(pattern.sum())
+    shrinking, shrinking_energy = pattern.copy(), energy.copy()
+    for rank in range(ones - 1, -1, -1):
+        cluster = tightest_cluster(shrinking, shrinking_energy)
+        toggle(shrinking, shrinking_energy, cluster, False)
+        ranks[cluster] = rank
+    for rank in range(ones, n):
+        void = largest_void(pattern, energy)
+        toggle(pattern, energy, void, True)
+        ranks[void] = rank
+    return ranks.reshape(size, size)
+
+
+def cache_dir():
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "graphics"
+
+
+@cache
+def blue_noise(size=64):
+    """Blue noise threshold tile, centered like ordered_tile. Generated once and kept on disk."""
+    path = cache_dir() / f"blue_noise_{size}.npy"
+    try:
+        ranks = np.load(path)
+    except (OSError, ValueError):
+        ranks = void_and_cluster(size)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # write then rename, so a concurrent reader never sees half a file
+            partial_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(partial_path, "wb") as file:
+                np.save(file, ranks)
+            os.replace(partial_path, path)
+        except OSError:
+            pass
+    return ranks / ranks.size - 0.5
 
 
 @cache
@@ -27,66 +100,272 @@ def ordered_tile(pow2, pre=True):
     return res
 
 
-def ordered_dither(image, bitness):
-    h, w = image.shape[:2]
-    q = 2**bitness - 1
-    tile_map = np.tile(ordered_tile(3), (ceil(h / 8), ceil(w / 8)))[:h, :w]
-    return np.round(image * q + tile_map[:, :, np.newaxis]) / q
+def add_tiled(out, tile):
+    """Adds `tile`, repeated over the whole image, to `out` in place through block views.
+
+    The image is covered by up to four grids of equal blocks (the full tiles and the partial
+    ones along the bottom and right edges), and each grid gets the tile broadcast onto a
+    blockwise view of it, so no image-sized threshold map is built.
+    """
+    h, w = out.shape[:2]
+    th, tw = tile.shape
+    tile = tile.reshape(tile.shape + (1,) * (out.ndim - 2))
+    for rows, bh in [(slice(0, h - h % th), th), (slice(h - h % th, h), h % th)]:
+        for cols, bw in [(slice(0, w - w % tw), tw), (slice(w - w % tw, w), w % tw)]:
+            part = out[rows, cols]
+            if part.size:
+                blocks = blockwise_view(part, (bh, bw) + out.shape[2:])
+                blocks += tile[:bh, :bw]
+
+
+def quantize(out, q, palette):
+    """Finishes a threshold or noise dither of `out`, which holds the image times `q` plus offsets."""
+    if palette is None:
+        np.round(out, out=out)
+    out /= q
+    return out if palette is None else map_to_palette(out, palette, out=out)
+
+
+def threshold_dither(image, bitness, tile, state=None, palette=None):
+    q = 2**bitness - 1 if palette is None else palette_levels(palette)
+    # rows already dithered by earlier strips of the same image shift the threshold pattern
+    top = state.get("row", 0) if state is not None else 0
+    if state is not None:
+        state["row"] = top + image.shape[0]
+    out = image * q
+    add_tiled(out, np.roll(tile, -(top % tile.shape[0]), axis=0).astype(out.dtype))
+    return quantize(out, q, palette)
+
+
+def ordered_dither(image, bitness, state=None, order=3, palette=None):
+    """Dithers with the 2**order x 2**order Bayer matrix."""
+    return threshold_dither(image, bitness, np.atleast_2d(ordered_tile(order)), state, palette)
+
+
+def blue_noise_dither(image, bitness, state=None, size=64, palette=None):
+    return threshold_dither(image, bitness, blue_noise(size), state, palette)
+
+
+def new_seed():
+    return int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+
+
+def noise_rows(seed, tile, skip, rows, shape, dtype):
+    """Rows `skip` to `skip + rows` of the noise of band `tile`, from a Philox keyed by seed and band."""
+    generator = np.random.Generator(np.random.Philox(key=np.array([seed, tile], np.uint64)))
+    return generator.random((skip + rows,) + shape, dtype=dtype)[skip:]
+
+
+def add_noise(out, seed, top, sync_channels, workers=1):
+    """Adds uniform noise in [-0.5, 0.5) to `out`, whose first row is row `top` of the image.
+
+    The noise of every band of NOISE_ROWS image rows comes from its own counter-based generator,
+    so it only depends on the seed and the rows, not on how the image is cut into strips or
+    spread over workers, and only one band of noise is alive per worker.
+    """
+    h, w = out.shape[:2]
+    shape = (w,) if sync_channels else out.shape[1:]
 
+    def add(tile):
+        first, last = max(tile * NOISE_ROWS, top), min((tile + 1) * NOISE_ROWS, top + h)
+        noise = noise_rows(seed, tile, first - tile * NOISE_ROWS, last - first, shape, out.dtype)
+        noise -= 0.5
+        out[first - top : last - top] += noise[:, :, np.newaxis] if sync_channels else noise
 
-def random_dither(image, bitness, sync_channels):
-    q = 2**bitness - 1
-    if sync_channels:
-        random_map = rng.random(size=image.shape[:2])[:, :, np.newaxis] - 0.5
+    tiles = range(top // NOISE_ROWS, (top + h - 1) // NOISE_ROWS + 1)
+    if workers == 1:
+        for tile in tiles:
+            add(tile)
     else:
-        random_map = rng.random(size=image.shape) - 0.5
-    return np.round(image * q + random_map) / q
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(add, tiles))
+
+
+def random_dither(image, bitness, sync_channels, state=None, palette=None, seed=None, workers=1):
+    """Dithers with uniform noise, reproducible for a given `seed` (a fresh one if None).
+
+    Strips of one image share the seed through `state`.
+    """
+    q = 2**bitness - 1 if palette is None else palette_levels(palette)
+    top = 0
+    if state is not None:
+        seed = state.setdefault("seed", new_seed() if seed is None else seed)
+        top = state.get("row", 0)
+        state["row"] = top + image.shape[0]
+    elif seed is None:
+        seed = new_seed()
+    out = image * q
+    add_noise(out, seed, top, sync_channels, workers)
+    return quantize(out, q, palette)
+
+
+@dataclass(frozen=True)
+class DiffusionKernel:
+    """`weights[di, dj] / divisor` of a pixel's error goes `di` rows down and `dj` columns ahead."""
+
+    divisor: int
+    weights: dict
+
+    @property
+    def rows_below(self):
+        return max(di for di, _ in self.weights)
+
+    @property
+    def reach(self):
+        # the furthest any error goes sideways, the width of the spare columns on either side
+        return max(abs(dj) for _, dj in self.weights)
+
+    def arrays(self):
+        offsets = np.array(list(self.weights), dtype=np.int64).reshape(-1, 2)
+        weights = np.array(list(self.weights.values()), dtype=float)
+        return offsets[:, 0].copy(), offsets[:, 1].copy(), weights, float(self.divisor)
+
+
+floyd_steinberg = DiffusionKernel(16, {(0, 1): 7, (1, -1): 3, (1, 0): 5, (1, 1): 1})
+atkinson = DiffusionKernel(8, {(0, 1): 1, (0, 2): 1, (1, -1): 1, (1, 0): 1, (1, 1): 1, (2, 0): 1})
+jarvis_judice_ninke = DiffusionKernel(
+    48,
+    {
+        **{(0, 1): 7, (0, 2): 5},
+        **{(1, -2): 3, (1, -1): 5, (1, 0): 7, (1, 1): 5, (1, 2): 3},
+        **{(2, -2): 1, (2, -1): 3, (2, 0): 5, (2, 1): 3, (2, 2): 1},
+    },
+)
+stucki = DiffusionKernel(
+    42,
+    {
+        **{(0, 1): 8, (0, 2): 4},
+        **{(1, -2): 2, (1, -1): 4, (1, 0): 8, (1, 1): 4, (1, 2): 2},
+        **{(2, -2): 1, (2, -1): 2, (2, 0): 4, (2, 1): 2, (2, 2): 1},
+    },
+)
+burkes = DiffusionKernel(32, {(0, 1): 8, (0, 2): 4, (1, -2): 2, (1, -1): 4, (1, 0): 8, (1, 1): 4, (1, 2): 2})
+sierra = DiffusionKernel(
+    32,
+    {
+        **{(0, 1): 5, (0, 2): 3},
+        **{(1, -2): 2, (1, -1): 4, (1, 0): 5, (1, 1): 4, (1, 2): 2},
+        **{(2, -1): 2, (2, 0): 3, (2, 1): 2},
+    },
+)
+two_row_sierra = DiffusionKernel(16, {(0, 1): 4, (0, 2): 3, (1, -2): 1, (1, -1): 2, (1, 0): 3, (1, 1): 2, (1, 2): 1})
+sierra_lite = DiffusionKernel(4, {(0, 1): 2, (1, -1): 1, (1, 0): 1})
+
+
+# The error buffer `ww` is a ring of rows: row i of the image keeps its error in row i % len(ww),
+# which is cleared as soon as the image row is done and then serves a row further down.
 
 
 @njit(cache=True)
-def floyd_dither(image, bitness):
-    q = 2**bitness - 1
-    image *= q
-    h, w = image.shape[:2]
-    ww = np.zeros((h + 1, w + 1, 3))
-    new = np.zeros(3)
-    for i in range(h):
-        for j in range(w):
-            image[i, j] += ww[i, j]
-            np.round(image[i, j], 0, new)
-            np.clip(new, 0, q, out=new)
-            err = (image[i, j] - new) / 16
-            image[i, j] = new
-            ww[i, j + 1] += err * 7
-            ww[i + 1, j - 1] += err * 3
-            ww[i + 1, j] += err * 5
-            ww[i + 1, j + 1] += err
-    return image / q
+def diffuse_pixel(image, ww, i, j, direction, q, palette, new, slots, dj, weights, divisor, reach):
+    image[i, j] += ww[i % ww.shape[0], reach + j]
+    colors, starts, candidates, size = palette
+    if colors.shape[0]:
+        new[:] = colors[nearest_color(image[i, j], colors, starts, candidates, size)]
+    else:
+        np.round(image[i, j], 0, new)
+        np.clip(new, 0, q, out=new)
+    for c in range(3):
+        err = (image[i, j, c] - new[c]) / divisor
+        for k in range(weights.shape[0]):
+            ww[slots[k], reach + j + direction * dj[k], c] += err * weights[k]
+    image[i, j] = new
 
 
 @njit(cache=True)
-def atkinson_dither(image, bitness):
-    q = 2**bitness - 1
-    image *= q
+def diffuse(image, q, palette, ww, di, dj, weights, divisor, reach, serpentine, parity):
     h, w = image.shape[:2]
-    ww = np.zeros((h + 2, w + 2, 3))
-    new = np.zeros(3)
+    new = np.zeros(3, image.dtype)
     for i in range(h):
-        for j in range(w):
-            image[i, j] += ww[i, j]
-            np.round(image[i, j], 0, new)
-            np.clip(new, 0, q, out=new)
-            err = (image[i, j] - new) / 8
-            image[i, j] = new
-            for (di, dj) in [(0, 1), (0, 2), (1, -1), (1, 0), (1, 1), (2, 0)]:
-                ww[i + di, j + dj] += err
-    return image / q
+        slots = (i + di) % ww.shape[0]
+        if serpentine and (i + parity) % 2:
+            for j in range(w - 1, -1, -1):
+                diffuse_pixel(image, ww, i, j, -1, q, palette, new, slots, dj, weights, divisor, reach)
+        else:
+            for j in range(w):
+                diffuse_pixel(image, ww, i, j, 1, q, palette, new, slots, dj, weights, divisor, reach)
+        ww[i % ww.shape[0]] = 0
+    return image
+
+
+# Wavefront schedule: the image is cut into column blocks, and at every step row i works on
+# block step - 2 * i, two blocks behind the row above. With blocks at least as wide as the
+# kernel reaches left and right together, every error cell receives its additions in the same
+# order as in the serial scan, and the output is bit-identical. The rows of a step run in
+# parallel. Left to right rows only, so not for serpentine scans.
+
+
+@njit(parallel=True, cache=True)
+def diffuse_wavefront(image, q, palette, ww, di, dj, weights, divisor, reach, block):
+    h, w = image.shape[:2]
+    blocks = (w + block - 1) // block
+    for step in range(blocks + 2 * (h - 1)):
+        for i in prange(max(0, (step - blocks) // 2 + 1), min(h - 1, step // 2) + 1):
+            new = np.zeros(3, image.dtype)
+            slots = (i + di) % ww.shape[0]
+            b = step - 2 * i
+            for j in range(b * block, min((b + 1) * block, w)):
+                diffuse_pixel(image, ww, i, j, 1, q, palette, new, slots, dj, weights, divisor, reach)
+            if (b + 1) * block >= w:
+                ww[i % ww.shape[0]] = 0
+    return image
+
+
+def error_diffusion(kernel):
+    """Makes a dither function out of a DiffusionKernel.
+
+    All kernels share one compiled engine, which takes the kernel as arrays. The error buffer
+    only holds the rows the kernel reaches, plus the rows in flight in a wavefront, and spare
+    columns that absorb what falls off either edge. When a `state` dict is passed, the error
+    pushed below one strip is carried into the next. Images of at least `PARALLEL_PIXELS`
+    pixels go through the wavefront on all of numba's threads unless `parallel` says otherwise;
+    the result is the same either way.
+    """
+    di, dj, weights, divisor = kernel.arrays()
+    rows_below, reach = kernel.rows_below, kernel.reach
+
+    def dither(image, bitness, state=None, parallel=None, serpentine=False, palette=None):
+        # a palette is searched in the unit cube itself, grid levels are rounded to at scale q
+        q = 2**bitness - 1 if palette is None else 1
+        search = no_palette() if palette is None else palette_index(palette)
+        h, w = image.shape[:2]
+        top = state.get("row", 0) if state is not None else 0
+        if parallel is None:
+            parallel = h * w >= PARALLEL_PIXELS and get_num_threads() > 1
+        parallel = parallel and not serpentine
+        block = max(WAVEFRONT_BLOCK, 2 * reach)
+        rows = rows_below + 1 + (ceil(w / block) // 2 + 1 if parallel else 0)
+        ww = np.zeros((rows, w + 2 * reach, 3), image.dtype)
+        if state is not None and "carry" in state:
+            ww[:rows_below] = state["carry"]
+        if parallel:
+            image = diffuse_wavefront(image * q, q, search, ww, di, dj, weights, divisor, reach, block)
+        else:
+            image = diffuse(image * q, q, search, ww, di, dj, weights, divisor, reach, serpentine, top % 2)
+        if state is not None:
+            state["carry"] = ww[np.arange(h, h + rows_below) % rows]
+            state["row"] = top + h
+        return image / q
+
+    return dither
+
+
+floyd_dither = error_diffusion(floyd_steinberg)
+atkinson_dither = error_diffusion(atkinson)
 
 
 algos = {
     "ordered": ordered_dither,
+    "ordered_16x16": partial(ordered_dither, order=4),
+    "blue_noise": blue_noise_dither,
     "random_sync": partial(random_dither, sync_channels=True),
     "random_nosync": partial(random_dither, sync_channels=False),
     "floyd": floyd_dither,
     "atkinson": atkinson_dither,
+    "jarvis": error_diffusion(jarvis_judice_ninke),
+    "stucki": error_diffusion(stucki),
+    "burkes": error_diffusion(burkes),
+    "sierra": error_diffusion(sierra),
+    "two_row_sierra": error_diffusion(two_row_sierra),
+    "sierra_lite": error_diffusion(sierra_lite),
 }
@@ -0,0 +1,62 @@
+"""numba, imported on first use.
+
+Importing numba takes longer than everything else the package imports, and reading or writing
+files never runs a kernel. So `njit` here only records the function. The first call of a kernel
+imports numba, turns every recorded kernel into a real dispatcher and puts the dispatchers (and
+numba's prange) into the modules' globals in place of the placeholders, so that compiled
+kernels can call each other. Compilation itself still happens per signature on first call, or
+is loaded from numba's on-disk cache (see graphics.warmup).
+"""
+
+kernels = []
+
+
+def prange(*args):
+    """Placeholder for numba.prange, swapped in before any kernel is compiled."""
+    return range(*args)
+
+
+def get_num_threads():
+    import numba
+
+    return numba.get_num_threads()
+
+
+class Kernel:
+    def __init__(self, func, options):
+        self.func = func
+        self.options = options
+        self.dispatcher = None
+        kernels.append(self)
+
+    def __call__(self, *args):
+        if self.dispatcher is None:
+            load()
+        return self.dispatcher(*args)
+
+    def __getattr__(self, name):
+        # signatures, py_func and the rest of the dispatcher
+        if self.__dict__.get("dispatcher") is None:
+            load()
+        return getattr(self.dispatcher, name)
+
+
+def njit(*args, **options):
+    if args and callable(args[0]):
+        return Kernel(args[0], options)
+    return lambda func: Kernel(func, options)
+
+
+def load():
+    import numba
+
+    for kernel in kernels:
+        if kernel.dispatcher is None:
+            kernel.dispatcher = numba.njit(**kernel.options)(kernel.func)
+    for kernel in kernels:
+        namespace = kernel.func.__globals__
+        for name, value in list(namespace.items()):
+            if isinstance(value, Kernel):
+                namespace[name] = value.dispatcher
+            elif value is prange:
+                namespace[name] = numba.prange
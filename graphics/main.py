@@ -1,13 +1,13 @@
 import numpy as np
 import PySimpleGUI as sg
 
-from .colors import Image, color_modes
+from .colors import Image, color_modes, parse_gamma
 from .dither import algos
 from .draw import draw_line
-from .png import read_png, write_png
+from .png import PngReader, write_png
 from .pnm import open_pnm_file, read_pnm, write_pnm
 from .ui_utils import draw_image, handle_exception, open_window, require_filename
-from .utils import normalize, to_8bit
+from .utils import working
 
 sg.theme("DarkGray15")
 get_image_info_layout = [
@@ -20,21 +20,22 @@ values = require_filename("Open PNM", get_image_info_layout)
 if not values:
     exit()
 filename, color_mode = values["filename"], values["color_mode"][0]
+is_png = str(filename).split(".")[-1] == "png"
 image = None
 image_data = None
 h = 0
 w = 0
 with handle_exception(exit_on_error=True):
     with open_pnm_file(filename, "rb") as file:
-        if str(filename).split(".")[-1] != "png":
-            image_data, max_val = read_pnm(file)
+        if not is_png:
+            image_data, max_val = read_pnm(file, mmap=True)
             h, w = image_data.shape[:2]
-            image_data = normalize(image_data, max_val)
-            image = Image(image_data, color_mode)
+            image = Image(image_data, color_mode, max_val=max_val)
         else:
-            image_data, gamma = read_png(file)
-            h, w = image_data.shape[:2]
-            image = Image(normalize(image_data, 255), color_mode, gamma)
+            # only the header here, pixels are decoded progressively once the window is up
+            png = PngReader(file)
+            h, w = png.shape[:2]
+            image = Image(working(np.zeros((h, w, 3))), gamma=png.gamma)
 
 channel = "All"
 layout = [
@@ -105,7 +106,16 @@ layout = [
 ]
 
 window = sg.Window("PNM", layout, finalize=True, element_justification="center")
-draw_image(window["graph"], image, color_mode, channel)
+if is_png:
+    with handle_exception(exit_on_error=True):
+        with open_pnm_file(filename, "rb") as file:
+            png = PngReader(file)
+            for image_data in png.progressive():
+                image = Image(image_data, color_mode, png.gamma, max_val=255)
+                draw_image(window["graph"], image, color_mode, channel)
+                window.refresh()
+else:
+    draw_image(window["graph"], image, color_mode, channel)
 p0, og_image = None, None
 with open_window(window) as evs:
     for event, values in evs:
@@ -117,7 +127,7 @@ with open_window(window) as evs:
             channel = values["channel"][0]
         if event in ["assign_gamma", "convert_gamma"]:
             try:
-                gamma = float(values["gamma"])
+                gamma = parse_gamma(values["gamma"])
             except ValueError:
                 window["gamma"].update(str(image.gamma))
             else:
@@ -137,7 +147,7 @@ with open_window(window) as evs:
                     else:
                         i = int(channel) - 1
                         image_data[:, :, i] = alpha * color[i] + (1 - alpha) * image_data[:, :, i]
-                    image = Image(image_data, color_mode, gamma=og_image.gamma)
+                    image = Image(working(image_data), color_mode, gamma=og_image.gamma)
             else:
                 p0, og_image = values["graph"], image
         if event == "graph+UP":
@@ -150,7 +160,8 @@ with open_window(window) as evs:
             except ValueError:
                 window["bitness"].update("8")
         if event == "gradient":
-            image = Image(np.tile(np.linspace((0, 0, 0), (1, 1, 1), 256), (256, 1, 1)), gamma=image.gamma)
+            gradient = working(np.tile(np.linspace((0, 0, 0), (1, 1, 1), 256), (256, 1, 1)))
+            image = Image(gradient, gamma=image.gamma)
         if event in ["color_mode", "channel", "assign_gamma", "convert_gamma", "graph", "dither", "gradient"]:
             draw_image(window["graph"], image, color_mode, channel)
         if event == "save":
@@ -164,6 +175,6 @@ with open_window(window) as evs:
                 with handle_exception(exit_on_error=False):
                     with open_pnm_file(filename, "wb") as file:
                         if str(filename).split(".")[-1] != "png":
-                            write_pnm(to_8bit(image.convert_gamma(2.2)[color_mode]), 255, file)
+                            write_pnm(image.convert_gamma(2.2).to_8bit(color_mode), 255, file)
                         else:
-                            write_png(to_8bit(image.convert_gamma(2.2)[color_mode]).astype(int), file, 2.2)
+                            write_png(image.convert_gamma(2.2).to_8bit(color_mode), file, 2.2)
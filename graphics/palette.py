@@ -0,0 +1,90 @@
+from functools import cache
+
+import numpy as np
+
+from .jit import njit, prange
+
+# cells per channel of the lookup grid over the unit rgb cube
+GRID_SIZE = 32
+
+
+def palette_index(palette):
+    """Nearest-color search structure for `palette`, an (n, 3) array of colors in [0, 1].
+
+    The unit cube is cut into GRID_SIZE**3 cells, and each cell lists the palette entries that
+    can be nearest to some point inside it: those no further from the cell than the furthest
+    point of the cell is from its best entry. A lookup then only compares against a handful of
+    candidates and is still exact. Built once per palette.
+    """
+    palette = np.ascontiguousarray(palette, dtype=float).reshape(-1, 3)
+    return build_index(palette.tobytes())
+
+
+@cache
+def build_index(data):
+    colors = np.frombuffer(data).reshape(-1, 3).copy()
+    edges = np.linspace(0, 1, GRID_SIZE + 1)
+    lo, hi = edges[:-1, np.newaxis], edges[1:, np.newaxis]
+    # per channel and cell: squared distances from each color to the nearest and furthest point
+    near, far = [], []
+    for c in range(3):
+        p = colors[:, c]
+        near.append(np.maximum(np.maximum(lo - p, p - hi), 0) ** 2)
+        far.append(np.maximum(np.abs(p - lo), np.abs(p - hi)) ** 2)
+    near = near[0][:, None, None] + near[1][None, :, None] + near[2][None, None, :]
+    far = far[0][:, None, None] + far[1][None, :, None] + far[2][None, None, :]
+    candidate = near <= far.min(axis=-1, keepdims=True)
+    counts = candidate.reshape(-1, len(colors)).sum(axis=1)
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    candidates = np.ascontiguousarray(np.nonzero(candidate.reshape(-1, len(colors)))[1])
+    return colors, starts, candidates, GRID_SIZE
+
+
+def no_palette():
+    return np.zeros((0, 3)), np.zeros(1, np.int64), np.zeros(0, np.int64), GRID_SIZE
+
+
+def palette_levels(palette):
+    """Levels per channel of the evenly spaced grid with as many colors as `palette`.
+
+    Threshold and noise dithering spread their offsets over one step of that grid.
+    """
+    return max(1.0, len(palette) ** (1 / 3) - 1)
+
+
+@njit(cache=True)
+def nearest_color(pixel, colors, starts, candidates, size):
+    cell = 0
+    inside = True
+    for c in range(3):
+        v = pixel[c]
+        if not 0 <= v <= 1:
+            inside = False
+            break
+        cell = cell * size + min(int(v * size), size - 1)
+    # outside the cube (pushed there by diffused error) every color is compared
+    start, count = (starts[cell], starts[cell + 1] - starts[cell]) if inside else (0, colors.shape[0])
+    best, best_dist = 0, np.inf
+    for n in range(count):
+        k = candidates[start + n] if inside else n
+        dist = 0.0
+        for c in range(3):
+            dist += (pixel[c] - colors[k, c]) ** 2
+        if dist < best_dist:
+            best, best_dist = k, dist
+    return best
+
+
+@njit(parallel=True, cache=True)
+def map_kernel(pixels, colors, starts, candidates, size, out):
+    for n in prange(pixels.shape[0]):
+        out[n] = colors[nearest_color(pixels[n], colors, starts, candidates, size)]
+
+
+def map_to_palette(image, palette, out=None):
+    """Replaces every pixel by its nearest palette color; `out` may be the image itself."""
+    if out is None:
+        out = np.empty_like(image)
+    pixels = np.ascontiguousarray(image).reshape(-1, 3)
+    map_kernel(pixels, *palette_index(palette), out.reshape(-1, 3))
+    return out
@@ -0,0 +1,113 @@
+import numpy as np
+
+from .colors import apply_gamma, convert_color
+from .dither import algos
+from .png import PngReader, PngWriter
+from .pnm import frame_format, parse_plain, pnm_format, read_header, read_into
+from .pnm.exceptions import FormatError
+from .utils import normalize
+
+STRIP_HEIGHT = 256
+
+
+def read_pnm_strips(file, rest, shape, dtype, max_val, strip_height):
+    height = shape[0]
+    for y in range(0, height, strip_height):
+        strip = np.empty((min(strip_height, height - y),) + shape[1:], dtype)
+        rest = read_into(file, rest, strip)
+        yield normalize(strip, max_val)
+
+
+def read_plain_strips(file, rest, shape, dtype, max_val, strip_height):
+    # plain bodies have no fixed row size, so they are only cut into strips once parsed
+    try:
+        image = parse_plain(rest + file.read(), dtype, max_val).reshape(shape)
+    except ValueError as e:
+        raise FormatError("image") from e
+    for y in range(0, shape[0], strip_height):
+        yield normalize(image[y : y + strip_height], max_val)
+
+
+def quantize(strip, max_val, dtype):
+    return np.round(strip * max_val).astype(dtype)
+
+
+class Pipeline:
+    """An image flowing through a chain of stages as row strips.
+
+    Stages are generators over strips, so only a strip per stage is alive at a time and nothing
+    runs until the pipeline is written or iterated. Stages that depend on earlier rows (error
+    diffusion, PNG filtering) carry their state from one strip to the next. The source file has
+    to stay open until then.
+    """
+
+    def __init__(self, strips, shape, gamma=2.2, color_mode="rgb"):
+        self.strips = strips
+        self.shape = shape
+        self.gamma = gamma
+        self.color_mode = color_mode
+
+    @classmethod
+    def from_pnm(cls, file, strip_height=STRIP_HEIGHT, gamma=2.2, color_mode="rgb"):
+        tag, width, height, max_val, rest = read_header(file)
+        shape, dtype = frame_format(tag, width, height, max_val)
+        read_strips = read_plain_strips if tag in [b"P2", b"P3"] else read_pnm_strips
+        strips = read_strips(file, rest, shape, dtype, max_val, strip_height)
+        return cls(strips, shape, gamma, color_mode)
+
+    @classmethod
+    def from_png(cls, file, strip_height=STRIP_HEIGHT, color_mode="rgb"):
+        png = PngReader(file)
+        strips = (normalize(strip, 255) for strip in png.strips(strip_height))
+        return cls(strips, png.shape, png.gamma, color_mode)
+
+    def __iter__(self):
+        return iter(self.strips)
+
+    def then(self, stage, **changes):
+        """Appends `stage`, a function from an iterator of strips to an iterator of strips."""
+        params = {"gamma": self.gamma, "color_mode": self.color_mode, **changes}
+        return Pipeline(stage(self.strips), self.shape, **params)
+
+    def convert_color(self, color_mode):
+        frm = self.color_mode
+
+        def stage(strips):
+            for strip in strips:
+                yield convert_color(strip, frm, color_mode)
+
+        return self.then(stage, color_mode=color_mode)
+
+    def convert_gamma(self, gamma):
+        rgb = self if self.color_mode == "rgb" else self.convert_color("rgb")
+        frm = self.gamma
+
+        def stage(strips):
+            for strip in strips:
+                yield apply_gamma(strip, frm, gamma)
+
+        return rgb.then(stage, gamma=gamma)
+
+    def dither(self, algo, bitness, **options):
+        """`options` go to the dither function, e.g. a `seed` or a `palette`."""
+        dither = algos[algo]
+
+        def stage(strips):
+            state = {}
+            for strip in strips:
+                yield dither(strip, bitness, state=state, **options)
+
+        return self.then(stage)
+
+    def write_pnm(self, file, max_val=255):
+        header, dtype = pnm_format(self.shape, max_val)
+        file.write(header)
+        for strip in self:
+            file.write(quantize(strip, max_val, dtype))
+
+    def write_png(self, file, **options):
+        height, width = self.shape[:2]
+        channels = 3 if len(self.shape) == 3 else 1
+        with PngWriter(file, width, height, channels, self.gamma, **options) as png:
+            for strip in self:
+                png.write(quantize(strip, 255, np.uint8))
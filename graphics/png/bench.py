@@ -0,0 +1,164 @@
+import os
+import zlib
+from pathlib import Path
+from timeit import default_timer
+
+import numpy as np
+
+from .deflate import ParallelCompressor
+from .filters import defilter, filter
+from .png import open_png_file
+
+HERE = Path(__file__).parent
+rng = np.random.default_rng(0)
+
+
+def paeth_predictor(a, b, c):
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    elif pb <= pc:
+        return b
+    else:
+        return c
+
+
+def legacy_defilter(data, width, height, bytes_per_pixel):
+    image = []
+    i = 0
+    for r in range(height):
+        filter_type = data[i]
+        i += 1
+        for c in range(width * bytes_per_pixel):
+            curr = data[i]
+            i += 1
+            raw_x_bpp = image[r * width * bytes_per_pixel + c - bytes_per_pixel] if c >= bytes_per_pixel else 0
+            prior_x = image[(r - 1) * width * bytes_per_pixel + c] if r > 0 else 0
+            prior_x_bpp = (
+                image[(r - 1) * width * bytes_per_pixel + c - bytes_per_pixel] if r > 0 and c >= bytes_per_pixel else 0
+            )
+            if filter_type == 0:
+                image.append(curr)
+            elif filter_type == 1:
+                image.append((curr + raw_x_bpp) & 0xFF)
+            elif filter_type == 2:
+                image.append((curr + prior_x) & 0xFF)
+            elif filter_type == 3:
+                image.append((curr + (raw_x_bpp + prior_x) // 2) & 0xFF)
+            elif filter_type == 4:
+                image.append((curr + paeth_predictor(raw_x_bpp, prior_x, prior_x_bpp)) & 0xFF)
+    return np.array(image).reshape(height, width, bytes_per_pixel)
+
+
+def legacy_filter(data, filter_type):
+    image = []
+    i = 0
+    height, width = data.shape[:2]
+    bytes_per_pixel = 3 if data.ndim == 3 else 1
+    data = list(data.ravel())
+    for r in range(height):
+        image.append(filter_type)
+        for c in range(width * bytes_per_pixel):
+            curr = data[i]
+            i += 1
+            raw_x_bpp = data[r * width * bytes_per_pixel + c - bytes_per_pixel] if c >= bytes_per_pixel else 0
+            prior_x = data[(r - 1) * width * bytes_per_pixel + c] if r > 0 else 0
+            prior_x_bpp = (
+                data[(r - 1) * width * bytes_per_pixel + c - bytes_per_pixel] if r > 0 and c >= bytes_per_pixel else 0
+            )
+            if filter_type == 0:
+                image.append(curr)
+            elif filter_type == 1:
+                image.append((curr - raw_x_bpp) & 0xFF)
+            elif filter_type == 2:
+                image.append((curr - prior_x) & 0xFF)
+            elif filter_type == 3:
+                image.append((curr - (raw_x_bpp + prior_x) // 2) & 0xFF)
+            elif filter_type == 4:
+                image.append((curr - paeth_predictor(raw_x_bpp, prior_x, prior_x_bpp)) & 0xFF)
+    return b"".join(int(byte).to_bytes(1, "big") for byte in image)
+
+
+def timed(f, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = default_timer()
+        result = f(*args)
+        best = min(best, default_timer() - start)
+    return best, result
+
+
+def synthetic(width, height, bytes_per_pixel):
+    lines = rng.integers(0, 256, size=(height, width * bytes_per_pixel + 1), dtype=np.uint8)
+    lines[:, 0] = rng.integers(0, 5, size=height)
+    return lines.tobytes()
+
+
+def png_idat(filename):
+    with open_png_file(filename, "rb") as file:
+        data = file.read()
+    width = int.from_bytes(data[16:20], "big")
+    height = int.from_bytes(data[20:24], "big")
+    idat = []
+    i = 8
+    while i < len(data):
+        length = int.from_bytes(data[i : i + 4], "big")
+        if data[i + 4 : i + 8] == b"IDAT":
+            idat.append(data[i + 8 : i + 8 + length])
+        i += length + 12
+    return zlib.decompress(b"".join(idat)), width, height, 3
+
+
+def bench_defilter(name, data, width, height, bytes_per_pixel, legacy=True):
+    defilter(data, 1, 1, bytes_per_pixel)  # warm up the jit
+    new_time, new = timed(defilter, data, width, height, bytes_per_pixel)
+    line = f"{name:>24} {width}x{height}x{bytes_per_pixel}: vectorized {new_time * 1000:9.1f} ms"
+    if legacy:
+        old_time, old = timed(legacy_defilter, data, width, height, bytes_per_pixel, repeat=1)
+        assert np.array_equal(old, new)
+        line += f", legacy {old_time * 1000:9.1f} ms, x{old_time / new_time:.0f}"
+    print(line)
+
+
+def bench_filter(name, image, legacy=True):
+    height, width = image.shape[:2]
+    new_time, new = timed(filter, image)
+    size = len(zlib.compress(new))
+    line = f"{name:>24} {width}x{height}: adaptive {new_time * 1000:9.1f} ms, {size} bytes"
+    if legacy:
+        old_time, old = timed(legacy_filter, image.astype(int), 4, repeat=1)
+        assert old == filter(image, 4).tobytes()
+        line += f", legacy paeth {old_time * 1000:9.1f} ms, {len(zlib.compress(old))} bytes, x{old_time / new_time:.0f}"
+    print(line)
+
+
+def bench_compress(name, image, block_size=1 << 20):
+    filtered = filter(image)
+    print(f"{name:>24} {image.shape[1]}x{image.shape[0]}, {filtered.nbytes >> 20} MiB filtered:")
+    base_time, expected = timed(zlib.compress, filtered)
+    print(f"{'zlib.compress':>24}: {base_time * 1000:9.1f} ms, {len(expected)} bytes")
+    workers = 1
+    while workers <= os.cpu_count():
+        def run():
+            compressor = ParallelCompressor(workers=workers, block_size=block_size)
+            return compressor.compress(filtered) + compressor.flush()
+
+        t, data = timed(run)
+        assert zlib.decompress(data) == filtered.tobytes()
+        speed = filtered.nbytes / t / (1 << 20)
+        print(f"{workers:>17} workers: {t * 1000:9.1f} ms, {len(data)} bytes, {speed:7.1f} MiB/s, x{base_time / t:.2f}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    bench_defilter("png3.png", *png_idat(HERE / "png3.png"))
+    bench_defilter("synthetic", synthetic(1024, 768, 3), 1024, 768, 3)
+    bench_defilter("synthetic", synthetic(4000, 3000, 3), 4000, 3000, 3, legacy=False)
+    bench_defilter("synthetic", synthetic(8000, 6000, 1), 8000, 6000, 1, legacy=False)
+    png3 = defilter(*png_idat(HERE / "png3.png"))
+    bench_filter("png3.png", png3)
+    bench_filter("tiled png3.png", np.tile(png3, (5, 5, 1)), legacy=False)
+    bench_compress("tiled png3.png", np.tile(png3, (5, 5, 1)))
@@ -0,0 +1,85 @@
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+ADLER_BASE = 65521
+WINDOW_SIZE = 1 << 15
+ZLIB_HEADER = b"\x78\x9c"
+
+
+def adler32_combine(adler1, adler2, length2):
+    """Adler-32 of the concatenation of two pieces from their checksums (as zlib's adler32_combine)."""
+    rem = length2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = rem * sum1 % ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + ADLER_BASE - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum2 >= ADLER_BASE << 1:
+        sum2 -= ADLER_BASE << 1
+    if sum2 >= ADLER_BASE:
+        sum2 -= ADLER_BASE
+    return sum1 | sum2 << 16
+
+
+def deflate_block(block, level, dictionary, final):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return data, zlib.adler32(block), len(block)
+
+
+class ParallelCompressor:
+    """Drop-in replacement for zlib.compressobj that deflates blocks on a thread pool, like pigz.
+
+    Input is cut into `block_size` blocks, each compressed as raw deflate primed with the last
+    32 KiB of the previous block and ended with a sync flush, so the pieces concatenate into one
+    valid stream. The zlib header and the combined Adler-32 are added around them. At most two
+    blocks per worker are in flight at a time.
+    """
+
+    def __init__(self, level=-1, workers=None, block_size=1 << 20):
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.futures = deque()
+        self.pending = bytearray()
+        self.dictionary = b""
+        self.adler = 1
+        self.started = False
+
+    def submit(self, block, final=False):
+        self.futures.append(self.pool.submit(deflate_block, block, self.level, self.dictionary, final))
+        self.dictionary = block[-WINDOW_SIZE:]
+
+    def collect(self, in_flight):
+        out = []
+        if not self.started:
+            out.append(ZLIB_HEADER)
+            self.started = True
+        while self.futures and (self.futures[0].done() or len(self.futures) > in_flight):
+            data, adler, length = self.futures.popleft().result()
+            self.adler = adler32_combine(self.adler, adler, length)
+            out.append(data)
+        return b"".join(out)
+
+    def compress(self, data):
+        self.pending += memoryview(data).cast("B")
+        while len(self.pending) >= self.block_size:
+            self.submit(bytes(self.pending[:self.block_size]))
+            del self.pending[:self.block_size]
+        return self.collect(2 * self.workers)
+
+    def flush(self):
+        self.submit(bytes(self.pending), final=True)
+        self.pending = bytearray()
+        data = self.collect(0)
+        self.pool.shutdown()
+        return data + self.adler.to_bytes(4, "big")
@@ -0,0 +1,109 @@
+import numpy as np
+
+from graphics.jit import njit
+from graphics.pnm.exceptions import *
+
+FILTER_TYPES = ["None", "Sub", "Up", "Average", "Paeth"]
+
+
+@njit(cache=True)
+def unaverage_row(line, prior, bytes_per_pixel, out):
+    for i in range(line.shape[0]):
+        left = int(out[i - bytes_per_pixel]) if i >= bytes_per_pixel else 0
+        out[i] = (int(line[i]) + (left + int(prior[i])) // 2) & 0xFF
+
+
+@njit(cache=True)
+def unpaeth_row(line, prior, bytes_per_pixel, out):
+    for i in range(line.shape[0]):
+        b = int(prior[i])
+        if i >= bytes_per_pixel:
+            a = int(out[i - bytes_per_pixel])
+            c = int(prior[i - bytes_per_pixel])
+        else:
+            a = 0
+            c = 0
+        p = a + b - c
+        pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+        if pa <= pb and pa <= pc:
+            pred = a
+        elif pb <= pc:
+            pred = b
+        else:
+            pred = c
+        out[i] = (int(line[i]) + pred) & 0xFF
+
+
+def defilter_row(filter_type, line, prior, bytes_per_pixel, out):
+    if filter_type == 0:  # None
+        out[:] = line
+    elif filter_type == 1:  # Sub
+        np.cumsum(line.reshape(-1, bytes_per_pixel), axis=0, dtype=np.uint8, out=out.reshape(-1, bytes_per_pixel))
+    elif filter_type == 2:  # Up
+        np.add(line, prior, out=out)
+    elif filter_type == 3:  # Average
+        unaverage_row(line, prior, bytes_per_pixel, out)
+    elif filter_type == 4:  # Paeth
+        unpaeth_row(line, prior, bytes_per_pixel, out)
+    else:
+        raise InvalidContent("IDAT", f"unknown filter type {filter_type}")
+
+
+def defilter(data, width, height, bytes_per_pixel, out=None):
+    stride = width * bytes_per_pixel
+    if len(data) < height * (stride + 1):
+        raise InvalidContent("IDAT", "image data length")
+    lines = np.frombuffer(data, np.uint8, count=height * (stride + 1)).reshape(height, stride + 1)
+    if out is None:
+        out = np.empty((height, width, bytes_per_pixel), np.uint8)
+    rows = out.reshape(height, stride)
+    prior = np.zeros(stride, np.uint8)
+    for r in range(height):
+        defilter_row(lines[r, 0], lines[r, 1:], prior, bytes_per_pixel, rows[r])
+        prior = rows[r]
+    return out
+
+
+def paeth_row(left, prior, prior_left):
+    a, b, c = (x.astype(np.int16) for x in (left, prior, prior_left))
+    pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2 * c)
+    return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c)).astype(np.uint8)
+
+
+def filter_candidates(line, prior, bytes_per_pixel, out):
+    left = np.zeros_like(line)
+    left[bytes_per_pixel:] = line[:-bytes_per_pixel]
+    prior_left = np.zeros_like(prior)
+    prior_left[bytes_per_pixel:] = prior[:-bytes_per_pixel]
+    out[0] = line  # None
+    np.subtract(line, left, out=out[1])  # Sub
+    np.subtract(line, prior, out=out[2])  # Up
+    np.subtract(line, ((left.astype(np.uint16) + prior) >> 1).astype(np.uint8), out=out[3])  # Average
+    np.subtract(line, paeth_row(left, prior, prior_left), out=out[4])  # Paeth
+    return out
+
+
+def filter_row(line, prior, bytes_per_pixel, out, filter_type=None):
+    candidates = filter_candidates(line, prior, bytes_per_pixel, np.empty((5, line.shape[0]), np.uint8))
+    if filter_type is None:
+        # minimum sum of absolute differences, bytes taken as signed
+        filter_type = int(np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=1).argmin())
+    elif filter_type not in range(5):
+        raise DataError("filter type")
+    out[0] = filter_type
+    out[1:] = candidates[filter_type]
+    return filter_type
+
+
+def filter(data, filter_type=None, prior=None):
+    height, width = data.shape[:2]
+    bytes_per_pixel = data.shape[2] if data.ndim == 3 else 1
+    stride = width * bytes_per_pixel
+    rows = np.ascontiguousarray(data, dtype=np.uint8).reshape(height, stride)
+    filtered = np.empty((height, stride + 1), np.uint8)
+    if prior is None:
+        prior = np.zeros(stride, np.uint8)
+    for r in range(height):
+        filter_row(rows[r], prior, bytes_per_pixel, filtered[r], filter_type)
+        prior = rows[r]
+    return filtered
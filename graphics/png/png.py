@@ -1,147 +1,102 @@
 from contextlib import contextmanager
+from dataclasses import dataclass
 from enum import Enum
 import io
 from math import floor
+import mmap
 
 import numpy as np
 
+from graphics.utils import SRGB
 from graphics.pnm.exceptions import *
 from time import sleep
 import zlib
 
+from .deflate import ParallelCompressor
+from .filters import defilter_row, filter
+
 PNG_SIGNATURE = bytes(bytearray.fromhex("89 50 4E 47 0D 0A 1A 0A"))
 ChunkType = Enum('ChunkType',
                  ['IHDR', 'PLTE', 'IDAT', 'IEND', 'bKGD', 'cHRM', 'gAMA', 'hIST', 'iCCP', 'iTXt', 'pHYs', 'sBIT',
                   'sPLT', 'sRGB', 'sTER', 'tEXt', 'tIME', 'tRNS', 'zTXt'])
 
-lookup_table = []
-
-
-def create_table():
-    for i in range(256):
-        k = i
-        for _ in range(8):
-            k = (k >> 1) ^ 0xedb88320 if k & 1 else k >> 1
-        lookup_table.append(k & 0xffffffff)
-
-
-def crc32(bytestream):
-    if len(lookup_table) == 0:
-        create_table()
-    crc = 0xffffffff
-    for byte in bytestream:
-        lookup_index = (crc ^ byte) & 0xff
-        crc = ((crc >> 8) & 0xffffffff) ^ lookup_table[lookup_index]
-    return crc ^ 0xffffffff
+def crc32(bytestream, crc=0):
+    return zlib.crc32(bytestream, crc)
 
 
 class Chunk:
+    __slots__ = ("chunk_type", "data")
+
     def __init__(self, chunk_type: ChunkType, data: bytes):
         self.chunk_type = chunk_type
         self.data = data
 
     def create_binary(self):
-        data = bytearray()
+        chunk_type = self.chunk_type.name.encode('ascii')
         length = len(self.data).to_bytes(4, "big")
-        data += length
-        chunk_type = self.chunk_type.name.encode('utf-8')
-        data += chunk_type
-        data += self.data
-        checksum_data = bytearray(chunk_type)
-        checksum_data += self.data
-        data += crc32(bytearray(checksum_data)).to_bytes(4, "big")
-        return data
+        checksum = crc32(self.data, crc32(chunk_type)).to_bytes(4, "big")
+        return b''.join((length, chunk_type, self.data, checksum))
 
 
 def build_chunk(name, content):
-    if name not in dir(ChunkType):
+    if name not in ChunkType.__members__:
         raise UnknownChunkType(name)
     return Chunk(ChunkType[name], content)
 
 
-def paeth_predictor(a, b, c):
-    p = a + b - c
-    pa = abs(p - a)
-    pb = abs(p - b)
-    pc = abs(p - c)
-    if pa <= pb and pa <= pc:
-        return a
-    elif pb <= pc:
-        return b
-    else:
-        return c
-
-
-def defilter(data, width, height, bytes_per_pixel):
-    image = []
-    i = 0
-    for r in range(height):  # for each scanline
-        filter_type = data[i]  # first byte of scanline is filter type
-        i += 1
-        for c in range(width * bytes_per_pixel):  # for each byte in scanline
-            curr = data[i]
-            i += 1
-            raw_x_bpp = (image[r * width * bytes_per_pixel + c - bytes_per_pixel] if c >= bytes_per_pixel else 0)
-            prior_x = (image[(r - 1) * width * bytes_per_pixel + c] if r > 0 else 0)
-            prior_x_bpp = (
-                image[(r - 1) * width * bytes_per_pixel + c - bytes_per_pixel] if r > 0 and c >= bytes_per_pixel else 0)
-            if filter_type == 0:  # None
-                image.append(curr)
-            elif filter_type == 1:  # Sub
-                image.append((curr + raw_x_bpp) & 0xff)
-            elif filter_type == 2:  # Up
-                image.append((curr + prior_x) & 0xff)
-            elif filter_type == 3:  # Average
-                image.append((curr + (raw_x_bpp + prior_x) // 2) & 0xff)
-            elif filter_type == 4:  # Paeth
-                image.append((curr + paeth_predictor(raw_x_bpp, prior_x, prior_x_bpp)) & 0xff)
-            else:
-                raise Exception('unknown filter type: ' + str(filter_type))
-    return image
+def chunk_name(name):
+    # a corrupted name may not even be ascii, which the CRC check has to report first
+    return bytes(name).decode('ascii', errors='replace')
 
 
-def filter(data, filter_type: int):
-    image = []
-    i = 0
-    height, width = data.shape[:2]
-    bytes_per_pixel = 3 if data.ndim == 3 else 1
-    data = list(data.ravel())
-    for r in range(height):  # for each scanline
-        image.append(filter_type)
-        for c in range(width * bytes_per_pixel):  # for each byte in scanline
-            curr = data[i]
-            i += 1
-            raw_x_bpp = (data[r * width * bytes_per_pixel + c - bytes_per_pixel] if c >= bytes_per_pixel else 0)
-            prior_x = (data[(r - 1) * width * bytes_per_pixel + c] if r > 0 else 0)
-            prior_x_bpp = (
-                data[(r - 1) * width * bytes_per_pixel + c - bytes_per_pixel] if r > 0 and c >= bytes_per_pixel else 0)
-            if filter_type == 0:  # None
-                image.append(curr)
-            # BUG
-            elif filter_type == 1:  # Sub
-                image.append((curr - raw_x_bpp) & 0xff)
-            elif filter_type == 2:  # Up
-                image.append((curr - prior_x) & 0xff)
-            elif filter_type == 3:  # Average
-                image.append((curr - (raw_x_bpp + prior_x) // 2) & 0xff)
-            elif filter_type == 4:  # Paeth
-                image.append((curr - paeth_predictor(raw_x_bpp, prior_x, prior_x_bpp)) & 0xff)
-            else:
-                raise Exception('unknown filter type: ' + str(filter_type))
-    return image
+def check_crc(name, checked, checksum):
+    if crc32(checked) != int.from_bytes(checksum, "big"):
+        raise ChecksumError(chunk_name(name))
 
 
 def apply_palette(image, palette):
-    if len(bytearray(palette)) % 3 != 0:
-        raise InvalidContent("PLTE", palette)
-    palette = np.array(bytearray(palette)).reshape(len(bytearray(palette)) // 3, 3)
-    converted_img = np.array([palette[pixel] for pixel in image])
-    return converted_img
-
-
-def build_image(chunks: list[Chunk]):
-    ihdr = next(chunk for chunk in chunks if chunk.chunk_type == ChunkType.IHDR)
-    reader = io.BytesIO(ihdr.data)
+    if len(palette) % 3 != 0:
+        raise InvalidContent("PLTE", bytes(palette))
+    palette = np.frombuffer(palette, np.uint8).reshape(-1, 3)
+    if image.size and image.max() >= len(palette):
+        raise InvalidContent("PLTE", "palette index out of range")
+    return palette[image]
+
+
+def build_palette(image, max_colors=256, band_height=64):
+    """Returns the palette and the index image of an RGB image with at most `max_colors` colors,
+    or None as soon as more colors turn up."""
+    packed = image[:, :, 0].astype(np.uint32) << 16 | image[:, :, 1].astype(np.uint32) << 8 | image[:, :, 2]
+    colors = np.empty(0, np.uint32)
+    for y in range(0, packed.shape[0], band_height):
+        colors = np.union1d(colors, packed[y:y + band_height])
+        if len(colors) > max_colors:
+            return None
+    palette = np.stack([colors >> 16, colors >> 8, colors], axis=1).astype(np.uint8)
+    return palette, np.searchsorted(colors, packed).astype(np.uint8)
+
+
+@dataclass
+class Header:
+    width: int
+    height: int
+    depth: int
+    color_type: int
+    deflate: int
+    filter: int
+    interlace: int
+
+    @property
+    def bytes_per_pixel(self):
+        return 3 if self.color_type == 2 else 1
+
+    @property
+    def stride(self):
+        return self.width * self.bytes_per_pixel
+
+
+def parse_header(data):
+    reader = io.BytesIO(data)
     width = int.from_bytes(reader.read(4), "big")
     height = int.from_bytes(reader.read(4), "big")
     depth = int.from_bytes(reader.read(1), "big")
@@ -149,24 +104,142 @@ def build_image(chunks: list[Chunk]):
     deflate = int.from_bytes(reader.read(1), "big")
     filter = int.from_bytes(reader.read(1), "big")
     interlace = int.from_bytes(reader.read(1), "big")
-    bytes_per_pixel = 3 if color_type == 2 else 1
-    if width == 0 or height == 0 or depth != 8 or color_type == 4 or color_type == 6 or deflate != 0 or interlace != 0:
-        InvalidContent("IHDR", ihdr.data)
+    if width == 0 or height == 0 or depth != 8 or color_type == 4 or color_type == 6 or deflate != 0 or interlace > 1:
+        raise InvalidContent("IHDR", data)
+    return Header(width, height, depth, color_type, deflate, filter, interlace)
+
+
+INFLATE_CHUNK = 1 << 16
+
+
+class Inflater:
+    """Hands out exact-size pieces of the decompressed IDAT stream, pulling payloads only as needed.
+
+    Payloads are fed to zlib in slices of INFLATE_CHUNK bytes and never inflated past the request,
+    so memory stays at a scanline plus the zlib window, and the unconsumed tail carried between
+    reads is at most one slice, however large a single IDAT is.
+    """
+
+    def __init__(self, payloads):
+        self.payloads = iter(payloads)
+        self.decompressor = zlib.decompressobj()
+        self.payload = memoryview(b"")
+        self.tail = b""
+        self.pending = bytearray()
+
+    def read(self, size):
+        while len(self.pending) < size:
+            if not self.tail and not self.payload:
+                payload = next(self.payloads, None)
+                if payload is None:
+                    # zlib may still hold output of input it has already taken
+                    rest = self.decompressor.decompress(b"", size - len(self.pending))
+                    if not rest:
+                        raise InvalidContent("IDAT", "image data length")
+                    self.pending += rest
+                    continue
+                self.payload = memoryview(payload)
+            if not self.tail:
+                self.tail, self.payload = self.payload[:INFLATE_CHUNK], self.payload[INFLATE_CHUNK:]
+            self.pending += self.decompressor.decompress(self.tail, size - len(self.pending))
+            self.tail = self.decompressor.unconsumed_tail
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
 
-    idat = b''.join(chunk.data for chunk in chunks if chunk.chunk_type == ChunkType.IDAT)
-    decoded = zlib.decompress(idat)
-    image = defilter(decoded, width, height, bytes_per_pixel)
+    def close(self):
+        for _ in self.payloads:
+            pass
+
+
+def defilter_lines(inflater, width, height, bytes_per_pixel, out=None):
+    stride = width * bytes_per_pixel
+    rows = np.empty((2, stride), np.uint8) if out is None else out.reshape(height, stride)
+    prior = np.zeros(stride, np.uint8)
+    for y in range(height):
+        line = np.frombuffer(inflater.read(stride + 1), np.uint8)
+        row = rows[y % 2] if out is None else rows[y]
+        defilter_row(line[0], line[1:], prior, bytes_per_pixel, row)
+        yield row
+        prior = row
+
+
+def decode_rows(header, payloads, out=None):
+    """Decompress and defilter IDAT payloads as they arrive, yielding one scanline at a time.
+
+    Without `out` only two row buffers are kept and reused, so a yielded row is overwritten
+    two steps later. With `out` (an array of `header.height * header.stride` bytes) every row
+    is defiltered in place into it.
+    """
+    inflater = Inflater(payloads)
+    yield from defilter_lines(inflater, header.width, header.height, header.bytes_per_pixel, out)
+    inflater.close()
+
+
+# (x0, y0, dx, dy) of each Adam7 pass
+ADAM7 = [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]
+# (row step, column step) of the pixel grid known after each pass
+ADAM7_GRID = [(8, 8), (8, 4), (4, 4), (4, 2), (2, 2), (2, 1), (1, 1)]
+
+
+def decode_passes(header, payloads, out):
+    """Decodes an Adam7 interlaced image into `out` of shape (height, width, bytes_per_pixel).
+
+    Every pass is defiltered on its own and scattered into a strided view of `out`; after each
+    pass the step of the regular pixel grid decoded so far is yielded.
+    """
+    inflater = Inflater(payloads)
+    bytes_per_pixel = header.bytes_per_pixel
+    for (x0, y0, dx, dy), grid in zip(ADAM7, ADAM7_GRID):
+        width = max(0, (header.width - x0 + dx - 1) // dx)
+        height = max(0, (header.height - y0 + dy - 1) // dy)
+        if width and height:
+            sub_image = np.empty((height, width, bytes_per_pixel), np.uint8)
+            for _ in defilter_lines(inflater, width, height, bytes_per_pixel, sub_image):
+                pass
+            out[y0::dy, x0::dx] = sub_image
+        yield grid
+    inflater.close()
+
+
+def expand_pixels(color_type, palette, image):
     if color_type == 3:
-        palette = next(chunk for chunk in chunks if chunk.chunk_type == ChunkType.PLTE)
-        image = apply_palette(image, palette.data)
-        image = np.array(image).reshape(height, width, 3)
+        return apply_palette(image[:, :, 0], palette)
     elif color_type == 2:
-        image = np.array(image).reshape(height, width, 3)
+        return image
     else:
-        image = np.array(image).reshape(height, width)
+        return image[:, :, 0]
+
+
+def fill_grid(coarse, grid, shape):
+    """Blows up every pixel of the grid decoded so far into a block, cropped to `shape`."""
+    dy, dx = grid
+    if grid == (1, 1):
+        return coarse
+    return np.repeat(np.repeat(coarse, dy, axis=0), dx, axis=1)[:shape[0], :shape[1]]
+
+
+def decode_image(header, payloads):
+    image = np.empty((header.height, header.width, header.bytes_per_pixel), np.uint8)
+    if header.interlace:
+        for _ in decode_passes(header, payloads, image):
+            pass
+    else:
+        for _ in decode_rows(header, payloads, out=image):
+            pass
     return image
 
 
+def build_image(chunks: list[Chunk]):
+    ihdr = next(chunk for chunk in chunks if chunk.chunk_type == ChunkType.IHDR)
+    header = parse_header(ihdr.data)
+    palette = next((chunk.data for chunk in chunks if chunk.chunk_type == ChunkType.PLTE), None)
+    if header.color_type == 3 and palette is None:
+        raise ChunkNotFound("PLTE")
+    idat = (chunk.data for chunk in chunks if chunk.chunk_type == ChunkType.IDAT)
+    return expand_pixels(header.color_type, palette, decode_image(header, idat))
+
+
 @contextmanager
 def open_png_file(filename, *args, **kwargs):
     try:
@@ -179,26 +252,50 @@ def open_png_file(filename, *args, **kwargs):
         file.close()
 
 
-def read_png(file):
-    reader = io.BufferedReader(file)
-    sign = reader.read(8)
-    # проверка подписи
-    if sign != PNG_SIGNATURE:
-        raise PngSignature(sign)
-    # разбиение на чанки
-    chunks = []
-    while True:
-        len = int.from_bytes(reader.read(4), "big")
-        name = reader.read(4).decode('ascii')
-        content = reader.read(len)
-        _checksum = reader.read(4)
-        if name == '':
-            if any([chunk.chunk_type == ChunkType.IEND for chunk in chunks]):
-                break
-            else:
-                raise ChunkNotFound("IEND")
-        chunks.append(build_chunk(name, content))
-
+def read_chunk(reader, verify_crc=True):
+    length = int.from_bytes(reader.read(4), "big")
+    name = reader.read(4)
+    if name == b'':
+        return None
+    content = reader.read(length)
+    checksum = reader.read(4)
+    if len(name) < 4 or len(content) < length or len(checksum) < 4:
+        raise InvalidContent(chunk_name(name), "chunk length")
+    if verify_crc and crc32(content, crc32(name)) != int.from_bytes(checksum, "big"):
+        raise ChecksumError(chunk_name(name))
+    return build_chunk(chunk_name(name), content)
+
+
+def map_chunks(buffer, offset=8, verify_crc=True):
+    """Yields chunks whose payloads are memoryview slices of `buffer`, without copying."""
+    while offset + 8 <= len(buffer):
+        length = int.from_bytes(buffer[offset:offset + 4], "big")
+        name = buffer[offset + 4:offset + 8]
+        end = offset + 8 + length
+        if end + 4 > len(buffer):
+            raise InvalidContent(chunk_name(name), "chunk length")
+        if verify_crc:
+            check_crc(name, buffer[offset + 4:end], buffer[end:end + 4])
+        yield build_chunk(chunk_name(name), buffer[offset + 8:end])
+        offset = end + 4
+
+
+def iter_chunks(file, verify_crc=True, use_mmap=True):
+    if use_mmap:
+        try:
+            buffer = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            pass
+        else:
+            yield from map_chunks(buffer, file.tell(), verify_crc)
+            return
+    chunk = read_chunk(file, verify_crc)
+    while chunk is not None:
+        yield chunk
+        chunk = read_chunk(file, verify_crc)
+
+
+def png_gamma(chunks):
     gamma = next((chunk for chunk in chunks if chunk.chunk_type == ChunkType.gAMA), None)
     if gamma is None:
         gamma = 2.2
@@ -206,43 +303,218 @@ def read_png(file):
         gamma = float(int.from_bytes(gamma.data, "big")) / 100000
     sRgb = next((chunk for chunk in chunks if chunk.chunk_type == ChunkType.sRGB), None)
     if sRgb is not None:
-        gamma = 2.2
-    return build_image(chunks), gamma
-
-
-def write_png(image, file, gamma, filter_type=4):
-    # Построение IHDR
-    chunks = []
-    ihdr_data = bytearray()
+        gamma = SRGB
+    return gamma
+
+
+class PngReader:
+    """Reads the chunks preceding the image data up front and decodes the image lazily.
+
+    IDAT chunks are only read from the file while rows are being requested, so iterating
+    `strips` keeps the memory footprint to a strip plus the decompressor state.
+    """
+
+    def __init__(self, file, verify_crc=True, use_mmap=True):
+        self.file = file
+        sign = file.read(8)
+        # проверка подписи
+        if sign != PNG_SIGNATURE:
+            raise PngSignature(sign)
+        self.chunks = []
+        self._chunks = iter_chunks(file, verify_crc, use_mmap)
+        chunk = next(self._chunks, None)
+        while chunk is not None and chunk.chunk_type not in (ChunkType.IDAT, ChunkType.IEND):
+            self.chunks.append(chunk)
+            chunk = next(self._chunks, None)
+        self._next_chunk = chunk
+        ihdr = next((chunk for chunk in self.chunks if chunk.chunk_type == ChunkType.IHDR), None)
+        if ihdr is None:
+            raise ChunkNotFound("IHDR")
+        self.header = parse_header(ihdr.data)
+        self.gamma = png_gamma(self.chunks)
+        self.palette = next((chunk.data for chunk in self.chunks if chunk.chunk_type == ChunkType.PLTE), None)
+        if self.header.color_type == 3 and self.palette is None:
+            raise ChunkNotFound("PLTE")
+
+    @property
+    def shape(self):
+        if self.header.color_type == 0:
+            return self.header.height, self.header.width
+        return self.header.height, self.header.width, 3
+
+    def payloads(self):
+        chunk = self._next_chunk
+        while chunk is not None and chunk.chunk_type == ChunkType.IDAT:
+            yield chunk.data
+            chunk = next(self._chunks, None)
+        while chunk is not None and chunk.chunk_type != ChunkType.IEND:
+            chunk = next(self._chunks, None)
+        if chunk is None:
+            raise ChunkNotFound("IEND")
+
+    def rows(self):
+        if self.header.interlace:
+            image = decode_image(self.header, self.payloads())
+            return iter(image.reshape(self.header.height, self.header.stride))
+        return decode_rows(self.header, self.payloads())
+
+    def strips(self, strip_height=1):
+        height, width, bytes_per_pixel = self.header.height, self.header.width, self.header.bytes_per_pixel
+        strip = None
+        for y, row in enumerate(self.rows()):
+            if y % strip_height == 0:
+                strip = np.empty((min(strip_height, height - y), width, bytes_per_pixel), np.uint8)
+            strip[y % strip_height] = row.reshape(width, bytes_per_pixel)
+            if y % strip_height == strip_height - 1 or y == height - 1:
+                yield expand_pixels(self.header.color_type, self.palette, strip)
+
+    def progressive(self):
+        """Yields the whole image after each Adam7 pass, with missing pixels filled from the
+        coarser grid; a non-interlaced image is yielded once, fully decoded."""
+        if not self.header.interlace:
+            yield self.read()
+            return
+        image = np.empty((self.header.height, self.header.width, self.header.bytes_per_pixel), np.uint8)
+        for dy, dx in decode_passes(self.header, self.payloads(), image):
+            coarse = expand_pixels(self.header.color_type, self.palette, image[::dy, ::dx])
+            yield fill_grid(coarse, (dy, dx), self.shape)
+
+    def read(self):
+        return expand_pixels(self.header.color_type, self.palette, decode_image(self.header, self.payloads()))
+
+
+def read_png(file, verify_crc=True):
+    png = PngReader(file, verify_crc)
+    return png.read(), png.gamma
+
+
+class PngWriter:
+    """Writes a PNG incrementally from row strips.
+
+    Each strip is filtered against the last row of the previous one and fed through a
+    zlib.compressobj; IDAT chunks of `idat_size` bytes are written as soon as enough
+    compressed output has built up. With `workers` other than 1 the deflate stream is
+    produced by a ParallelCompressor in blocks of `block_size` bytes (None uses every core).
+    """
+
+    def __init__(
+        self,
+        file,
+        width,
+        height,
+        channels=3,
+        gamma=2.2,
+        filter_type=None,
+        level=-1,
+        idat_size=8192,
+        palette=None,
+        workers=1,
+        block_size=1 << 20,
+    ):
+        if channels not in (1, 3) or palette is not None and channels != 1:
+            raise DataError("number of channels")
+        if palette is not None and not 0 < len(palette) <= 256:
+            raise DataError("palette size")
+        if palette is not None and filter_type is None:
+            # adaptive filtering does not pay off on palette indices
+            filter_type = 0
+        self.file = file
+        self.width, self.height, self.channels = width, height, channels
+        self.filter_type = filter_type
+        self.idat_size = idat_size
+        if workers == 1:
+            self.compressor = zlib.compressobj(level)
+        else:
+            self.compressor = ParallelCompressor(level, workers, block_size)
+        self.pending = bytearray()
+        self.prior = None
+        self.rows_written = 0
+
+        # Построение IHDR
+        ihdr_data = bytearray()
+        ihdr_data += width.to_bytes(4, "big")
+        ihdr_data += height.to_bytes(4, "big")
+        ihdr_data += bytes(b'\x08')
+        color_type = bytes(b'\x00')
+        if channels == 3:
+            color_type = bytes(b'\x02')
+        if palette is not None:
+            color_type = bytes(b'\x03')
+        ihdr_data += color_type
+        ihdr_data += bytes(b'\x00\x00\x00')
+        file.write(PNG_SIGNATURE)
+        file.write(Chunk(ChunkType.IHDR, ihdr_data).create_binary())
+        if gamma == SRGB:
+            # perceptual rendering intent, with the gAMA value the spec recommends alongside
+            file.write(Chunk(ChunkType.sRGB, b'\x00').create_binary())
+            file.write(Chunk(ChunkType.gAMA, (45455).to_bytes(4, "big")).create_binary())
+        else:
+            file.write(Chunk(ChunkType.gAMA, floor(gamma*10000).to_bytes(4, "big")).create_binary())
+        if palette is not None:
+            file.write(Chunk(ChunkType.PLTE, np.asarray(palette, np.uint8).tobytes()).create_binary())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write_idat(self, final=False):
+        while len(self.pending) >= self.idat_size or final and self.pending:
+            self.file.write(Chunk(ChunkType.IDAT, bytes(self.pending[:self.idat_size])).create_binary())
+            del self.pending[:self.idat_size]
+
+    def write(self, rows):
+        if rows.ndim == 1 or rows.ndim == 2 and self.channels == 3:
+            rows = rows[np.newaxis]
+        if rows.shape[1] != self.width or (rows.shape[2] if rows.ndim == 3 else 1) != self.channels:
+            raise DataError("row shape")
+        if self.rows_written + rows.shape[0] > self.height:
+            raise DataError("number of rows")
+        # Построение IDAT
+        self.pending += self.compressor.compress(filter(rows, self.filter_type, self.prior))
+        self.prior = np.ascontiguousarray(rows[-1], dtype=np.uint8).ravel()
+        self.rows_written += rows.shape[0]
+        self.write_idat()
+
+    def close(self):
+        if self.compressor is None:
+            return
+        if self.rows_written != self.height:
+            raise DataError("number of rows")
+        self.pending += self.compressor.flush()
+        self.compressor = None
+        self.write_idat(final=True)
+        self.file.write(Chunk(ChunkType.IEND, b'').create_binary())
+
+
+def write_png(
+    image, file, gamma, filter_type=None, level=-1, idat_size=8192, indexed=None, workers=1, block_size=1 << 20
+):
+    """Writes `image` as a PNG. RGB images with at most 256 colors are written as indexed color
+    (with a PLTE chunk) unless `indexed` is False; `indexed=True` makes that mandatory."""
     height, width = image.shape[:2]
-    ihdr_data += width.to_bytes(4, "big")
-    ihdr_data += height.to_bytes(4, "big")
-    ihdr_data += bytes(b'\x08')
-    color_type = bytes(b'\x00')
-    if image.ndim == 3:
-        color_type = bytes(b'\x02')
-    ihdr_data += color_type
-    ihdr_data += bytes(b'\x00\x00\x00')
-    IHDR = Chunk(ChunkType.IHDR, ihdr_data)
-    chunks.append(IHDR)
-
-    gAMA = Chunk(ChunkType.gAMA, floor(gamma*10000).to_bytes(4, "big"))
-    chunks.append(gAMA)
-
-    # Построение IDAT
-    filtered = filter(image, filter_type)
-    filtered = b''.join(int(byte).to_bytes(1, "big") for byte in filtered)
-    compressed = zlib.compress(filtered)
-    compressed_splitted = []
-    for i in range(0, len(compressed), 8192):
-        compressed_splitted.append(compressed[i:i + 8192])
-
-    for idat_data in compressed_splitted:
-        IDAT = Chunk(ChunkType.IDAT, idat_data)
-        chunks.append(IDAT)
-    IEND = Chunk(ChunkType.IEND, b'')
-    chunks.append(IEND)
-    file.write(PNG_SIGNATURE)
-    for chunk in chunks:
-        file.write(chunk.create_binary())
-
+    channels = 3 if image.ndim == 3 else 1
+    palette = None
+    if channels == 3 and indexed is not False:
+        found = build_palette(image)
+        if found is not None:
+            palette, image = found
+            channels = 1
+        elif indexed:
+            raise DataError("number of colors")
+    with PngWriter(
+        file,
+        width,
+        height,
+        channels,
+        gamma,
+        filter_type=filter_type,
+        level=level,
+        idat_size=idat_size,
+        palette=palette,
+        workers=workers,
+        block_size=block_size,
+    ) as png:
+        png.write(image)
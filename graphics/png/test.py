@@ -1,8 +1,12 @@
-from png import *
+from pathlib import Path
+
+from graphics.png import *
+
+here = Path(__file__).parent
 image = None
 gamma = None
-with open_png_file("png3.png", "rb") as file:
+with open_png_file(here / "png3.png", "rb") as file:
     image, gamma = read_png(file)
-file = open("test.png", "wb")
+file = open(here / "test.png", "wb")
 write_png(image, file, gamma)
 file.close()
@@ -48,3 +48,8 @@ class ChunkNotFound(PngError):
 class InvalidContent(PngError):
     chunk_name: str
     content: str
+
+
+@dataclass
+class ChecksumError(PngError):
+    chunk_name: str
@@ -1,6 +1,7 @@
 import io
+import re
 from contextlib import contextmanager
-from itertools import groupby, islice
+from functools import cache
 
 import numpy as np
 
@@ -8,6 +9,8 @@ from .exceptions import *
 
 U1 = 255
 U2 = 65535
+PLAIN_LINE = 70
+STRIP_BYTES = 1 << 20
 
 
 @contextmanager
@@ -22,24 +25,105 @@ def open_pnm_file(filename, *args, **kwargs):
         file.close()
 
 
-def read_pnm(file):
-    reader = io.BufferedReader(file)
-    tag = reader.read(2)
-    if tag in [b"P5", b"P6"]:
-        plain = False
-    elif tag in [b"P2", b"P3"]:
-        plain = True
-    else:
-        raise UnknownTagError(tag)
+SEPARATOR = rb"(?:\s|#[^\r\n]*[\r\n])+"
+HEADER = re.compile(rb"(P\d)" + SEPARATOR + rb"(\d+)" + SEPARATOR + rb"(\d+)" + SEPARATOR + rb"(\d+)\s")
+COMMENT = re.compile(rb"#[^\r\n]*")
+HEADER_BLOCK = 4096
+
+
+def read_block(reader, size=HEADER_BLOCK):
+    read1 = getattr(reader, "read1", reader.read)
+    return read1(size)
+
+
+def read_header(reader, buffer=b""):
+    """Parses a PNM header, skipping comments.
+
+    Reads in blocks rather than bytes and returns (tag, width, height, max_val, rest), where `rest`
+    holds whatever was read past the single whitespace character that ends the header. `buffer`
+    is data already read from `reader`.
+    """
+    while len(buffer) < 2:
+        block = read_block(reader)
+        if not block:
+            break
+        buffer += block
+    if buffer[:2] not in [b"P2", b"P3", b"P5", b"P6"]:
+        raise UnknownTagError(buffer[:2])
+    while True:
+        match = HEADER.match(buffer)
+        if match is not None:
+            break
+        block = read_block(reader)
+        if not block:
+            raise FormatError("header")
+        buffer += block
+    tag, width, height, max_val = match.groups()
+    return tag, int(width), int(height), int(max_val), buffer[match.end() :]
+
+
+def parse_plain(body, dtype, max_val):
+    if COMMENT.search(body):
+        body = COMMENT.sub(b"", body)
+    if not body.strip():
+        return np.empty(0, dtype)
+    values = np.fromstring(body, np.int64, sep=" ")
+    if values.size and (values.min() < 0 or values.max() > max_val):
+        raise ValueError("sample out of range")
+    return values.astype(dtype)
+
+
+def split_plain(text):
+    """Length of the leading part of `text` that ends between two samples and outside a comment."""
+    end = max(text.rfind(space) for space in (b" ", b"\t", b"\n", b"\r")) + 1
+    comment = text.rfind(b"#", 0, end)
+    if comment > max(text.rfind(b"\n"), text.rfind(b"\r")):
+        return comment
+    return end
+
+
+def read_plain(reader, rest, shape, dtype, max_val):
+    """Parses a plain body a block at a time into a new array of `shape`, so no more than the
+    samples and one block of text are ever held."""
+    out = np.empty(shape, dtype)
+    samples = out.reshape(-1)
+    n = 0
+    text = rest
+    while True:
+        block = read_block(reader, STRIP_BYTES)
+        text += block
+        end = split_plain(text) if block else len(text)
+        values = parse_plain(text[:end], dtype, max_val)
+        if n + len(values) > len(samples):
+            raise FormatError("image data length")
+        samples[n : n + len(values)] = values
+        n += len(values)
+        text = text[end:]
+        if not block:
+            break
+    if n != len(samples):
+        raise FormatError("image data length")
+    return out
+
+
+def check_samples(image, max_val):
+    # binary samples are stored in u1 or u2, which can hold values above a smaller max_val
+    if max_val < np.iinfo(image.dtype).max and image.size and image.max() > max_val:
+        raise FormatError("image")
 
-    data = iter(lambda: reader.read(1), b"")
-    fields = (b"".join(group).decode("ascii") for is_space, group in groupby(data, key=bytes.isspace) if not is_space)
 
+def map_pnm(file, offset, dtype, shape):
     try:
-        width, height, max_val = map(int, islice(fields, 0, 3))
+        file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    try:
+        return np.memmap(file, dtype, mode="r", offset=offset, shape=shape)
     except ValueError as e:
-        raise FormatError("header") from e
+        raise FormatError("image data length") from e
 
+
+def frame_format(tag, width, height, max_val):
     if tag in [b"P2", b"P5"]:
         shape = (height, width)
     else:
@@ -51,46 +135,176 @@ def read_pnm(file):
         dtype = np.dtype(">u2")
     else:
         raise FormatError("max_val")
+    return shape, dtype
 
-    try:
-        if plain:
-            image_data = np.fromiter(map(int, fields), dtype)
-        else:
-            image_data = np.frombuffer(reader.read(), dtype)
-    except ValueError as e:
-        raise FormatError("image") from e
+
+def read_pnm(file, mmap=False):
+    """Reads a PNM image, returning (image, max_val).
+
+    With `mmap`, binary images from real files come back as a read-only np.memmap at the data
+    offset in the file's own dtype, so nothing is read until it is accessed; their samples are
+    not checked against max_val then, which lookups through colors.lookup do on use.
+    """
+    tag, width, height, max_val, rest = read_header(file)
+    plain = tag in [b"P2", b"P3"]
+    shape, dtype = frame_format(tag, width, height, max_val)
+
+    if mmap and not plain:
+        image = map_pnm(file, file.tell() - len(rest), dtype, shape)
+        if image is not None:
+            return image, max_val
+
+    if not plain:
+        image = np.empty(shape, dtype)
+        # the body is read straight into the image; anything left over is not part of it
+        if read_into(file, rest, image) or file.read(1):
+            raise FormatError("image data length")
+        check_samples(image, max_val)
+        return image, max_val
 
     try:
-        image = image_data.reshape(shape)
+        image = read_plain(file, rest, shape, dtype, max_val)
     except ValueError as e:
-        raise FormatError("image data length") from e
+        raise FormatError("image") from e
 
     return image, max_val
 
 
-def write_pnm(image, max_val, file):
-    if image.ndim == 2:
-        tag = "P5"
-    elif image.ndim == 3:
-        tag = "P6"
-        if image.shape[2] != 3:
+def read_into(reader, rest, out):
+    """Fills `out` from `rest` and then the reader, returning the part of `rest` left over."""
+    view = memoryview(out).cast("B")
+    n = min(len(rest), len(view))
+    view[:n] = rest[:n]
+    while n < len(view):
+        got = reader.readinto(view[n:])
+        if not got:
+            raise FormatError("image data length")
+        n += got
+    return rest[len(view) :]
+
+
+def iter_pnm(file, reuse=False):
+    """Yields (image, max_val) for every frame of a stream of concatenated PNM images.
+
+    Only each frame's header and payload are read, so this works on pipes. With `reuse`, frames
+    of the same format are decoded into one preallocated array, which is overwritten by the next
+    frame. Plain frames have no length, so a plain image ends the stream.
+    """
+    rest = b""
+    out = None
+    while True:
+        rest = rest.lstrip()
+        if not rest:
+            rest = read_block(file)
+            if not rest.lstrip():
+                return
+            continue
+        tag, width, height, max_val, rest = read_header(file, rest)
+        shape, dtype = frame_format(tag, width, height, max_val)
+        if tag in [b"P2", b"P3"]:
+            try:
+                image = read_plain(file, rest, shape, dtype, max_val)
+            except ValueError as e:
+                raise FormatError("image") from e
+            yield image, max_val
+            return
+        if not reuse or out is None or out.shape != shape or out.dtype != dtype:
+            out = np.empty(shape, dtype)
+        rest = read_into(file, rest, out)
+        check_samples(out, max_val)
+        yield out, max_val
+
+
+def pnm_format(shape, max_val, plain=False):
+    if len(shape) == 2:
+        tag = "P2" if plain else "P5"
+    elif len(shape) == 3:
+        tag = "P3" if plain else "P6"
+        if shape[2] != 3:
             raise DataError("number of channels")
     else:
         raise DataError("array dimensions")
 
-    height, width = image.shape[:2]
-
-    try:
-        if max_val <= U1:
-            dtype = np.dtype("u1")
-        elif max_val <= U2:
-            dtype = np.dtype(">u2")
-        else:
-            raise DataError("max_val")
-        image = image.astype(dtype, casting="same_kind", copy=False)
-    except TypeError as e:
-        raise DataError("dtype") from e
+    if max_val <= U1:
+        dtype = np.dtype("u1")
+    elif max_val <= U2:
+        dtype = np.dtype(">u2")
+    else:
+        raise DataError("max_val")
 
+    height, width = shape[:2]
     header = f"{tag} {width} {height} {max_val}\n".encode("ascii")
+    return header, dtype
+
+
+@cache
+def plain_table(max_val):
+    """Right-aligned decimal text of every sample value, one fixed-width row per value."""
+    width = len(str(max_val)) + 1
+    text = "".join(f"{v:>{width - 1}} " for v in range(max_val + 1)).encode("ascii")
+    return np.frombuffer(text, np.uint8).reshape(max_val + 1, width)
+
+
+def format_plain(strip, max_val):
+    table = plain_table(max_val)
+    text = table[strip.reshape(strip.shape[0], -1)]
+    # break lines well below the 70 characters plain PNM allows, and after every image row
+    text[:, PLAIN_LINE // table.shape[1] - 1 :: PLAIN_LINE // table.shape[1], -1] = ord("\n")
+    text[:, -1, -1] = ord("\n")
+    return text
+
+
+def strips(image, strip_bytes=STRIP_BYTES):
+    rows = max(1, strip_bytes // max(1, image[:1].size * image.itemsize))
+    for y in range(0, image.shape[0], rows):
+        yield image[y : y + rows]
+
+
+def write_pnm(image, max_val, file, plain=False):
+    header, dtype = pnm_format(image.shape, max_val, plain)
+    if not np.can_cast(image.dtype, dtype, casting="same_kind"):
+        raise DataError("dtype")
+
     file.write(header)
-    file.write(image.tobytes())
+    if plain:
+        for strip in strips(image):
+            if strip.size and (strip.min() < 0 or strip.max() > max_val):
+                raise DataError("max_val")
+            file.write(format_plain(strip, max_val))
+    elif image.dtype == dtype and image.flags.c_contiguous:
+        file.write(memoryview(image).cast("B"))
+    else:
+        # only a strip at a time is converted or made contiguous
+        for strip in strips(image):
+            file.write(strip.astype(dtype, casting="same_kind"))
+
+
+class PnmWriter:
+    """Writes a stream of concatenated PNM frames, converting every frame through one reused
+    buffer instead of allocating a copy per frame."""
+
+    def __init__(self, file, max_val):
+        self.file = file
+        self.max_val = max_val
+        self.buffer = None
+        self.frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.flush()
+
+    def write(self, image):
+        header, dtype = pnm_format(image.shape, self.max_val)
+        if image.dtype != dtype or not image.flags.c_contiguous:
+            if self.buffer is None or self.buffer.shape != image.shape or self.buffer.dtype != dtype:
+                self.buffer = np.empty(image.shape, dtype)
+            try:
+                np.copyto(self.buffer, image, casting="same_kind")
+            except TypeError as e:
+                raise DataError("dtype") from e
+            image = self.buffer
+        self.file.write(header)
+        self.file.write(memoryview(image).cast("B"))
+        self.frames += 1
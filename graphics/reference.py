@@ -0,0 +1,92 @@
+"""Reference implementations the optimized code is checked against by the tests and timed
+against by the benchmarks."""
+import numpy as np
+
+from .colors import SRGB, apply_gamma, color_modes, convert_color, hsl_to_rgb, hsv_to_rgb, rgb_to_hsl, rgb_to_hsv
+from .dither import algos
+from .utils import normalize
+
+# the masked numpy conversions the compiled kernels replaced
+
+
+def legacy_get_h(image, c_max, c_delta, out):
+    has_delta = c_delta != 0
+    rmax = has_delta & (c_max == image[:, :, 0])
+    out[rmax] = (image[rmax, 1] - image[rmax, 2]) / c_delta[rmax]
+    gmax = has_delta & (c_max == image[:, :, 1])
+    out[gmax] = (image[gmax, 2] - image[gmax, 0]) / c_delta[gmax] + 2
+    bmax = has_delta & (c_max == image[:, :, 2])
+    out[bmax] = (image[bmax, 0] - image[bmax, 1]) / c_delta[bmax] + 4
+    out /= 6
+    out %= 1
+
+
+def legacy_get_sl(c_max, c_sum, c_delta, out):
+    out[:, :, 1] = l = c_sum / 2
+    ok = (l != 0) & (l != 1)
+    out[ok, 0] = c_delta[ok] / (1 - np.abs(c_sum[ok] - 1))
+
+
+def legacy_get_sv(c_max, c_sum, c_delta, out):
+    out[:, :, 1] = v = c_max
+    ok = v != 0
+    out[ok, 0] = c_delta[ok] / v[ok]
+
+
+def legacy_rgb_to_hsx(get_sx):
+    def convert(image):
+        new = np.zeros_like(image)
+        c_min, c_max = image.min(axis=2), image.max(axis=2)
+        c_sum, c_delta = c_max + c_min, c_max - c_min
+        legacy_get_h(image, c_max, c_delta, new[:, :, 0])
+        get_sx(c_max, c_sum, c_delta, new[:, :, 1:])
+        return new
+
+    return convert
+
+
+def legacy_hsl_to_rgb(image):
+    new = np.zeros_like(image)
+    alpha = image[:, :, 1] * np.minimum(image[:, :, 2], 1 - image[:, :, 2])
+    for i, n in enumerate([0, 8, 4]):
+        k = (n + image[:, :, 0] * 12) % 12
+        new[:, :, i] = image[:, :, 2] - alpha * np.maximum(-1, np.minimum(k - 3, np.minimum(9 - k, 1)))
+    return new
+
+
+def legacy_hsv_to_rgb(image):
+    new = np.zeros_like(image)
+    for i, n in enumerate([5, 3, 1]):
+        k = (n + image[:, :, 0] * 6) % 6
+        new[:, :, i] = image[:, :, 2] * (1 - image[:, :, 1] * np.maximum(0, np.minimum(k, np.minimum(4 - k, 1))))
+    return new
+
+
+def hsx_test_image(shape):
+    # random colors plus grays, pure hues and ties between channels
+    image = np.random.default_rng(0).random(shape)
+    levels = np.array([0, 0.25, 0.5, 1])
+    corners = np.stack(np.meshgrid(levels, levels, levels), axis=-1).reshape(-1, 3)
+    image.reshape(-1, 3)[: len(corners)] = corners
+    return image
+
+
+hsx_conversions = [
+    ("rgb -> hsl", rgb_to_hsl, legacy_rgb_to_hsx(legacy_get_sl)),
+    ("rgb -> hsv", rgb_to_hsv, legacy_rgb_to_hsx(legacy_get_sv)),
+    ("hsl -> rgb", hsl_to_rgb, legacy_hsl_to_rgb),
+    ("hsv -> rgb", hsv_to_rgb, legacy_hsv_to_rgb),
+]
+
+
+def precision_stages(raw, max_val):
+    """Every stage of the usual work on `raw`, in the current precision, to hold float32 against float64."""
+    image = normalize(raw, max_val)
+    stages = {"normalize": image}
+    for mode in color_modes[1:]:
+        stages[f"rgb -> {mode}"] = converted = convert_color(image, "rgb", mode)
+        stages[f"{mode} -> rgb"] = convert_color(converted, mode, "rgb")
+    stages["gamma 2.2 -> 1"] = linear = apply_gamma(image, 2.2, 1)
+    stages["gamma 1 -> srgb"] = apply_gamma(linear, 1, SRGB)
+    stages["ordered dither"] = algos["ordered"](linear, 2)
+    return stages
@@ -0,0 +1,108 @@
+from functools import lru_cache
+
+import numpy as np
+
+from .colors import GAMMA_TABLES, apply_gamma, convert_color, gamma_table, image_cache, lookup
+from .pnm import pnm_format
+from .utils import float_dtype, normalize, to_8bit
+
+STRIP_BYTES = 1 << 20
+
+
+@lru_cache(maxsize=GAMMA_TABLES)
+def display_table(frm, to, max_val):
+    """Integer samples of depth `max_val` at gamma `frm` straight to 8-bit samples at gamma `to`."""
+    if frm == to:
+        return to_8bit(np.arange(max_val + 1), max_val)
+    return to_8bit(gamma_table(frm, to, max_val, np.dtype(float)))
+
+
+class Render:
+    """The steps from an Image to the bytes of a displayable PNM, recorded lazily.
+
+    Nothing is computed until `pnm` is called, which runs all steps in one pass over row strips
+    straight into the output buffer, so no full-size intermediate is materialized. Raw integer
+    samples that only need a gamma change go through a single table lookup instead. The result
+    is kept in the image cache under the image's family and gamma, which only change together
+    with its pixels, so rendering the same view again costs a dict lookup.
+    """
+
+    def __init__(self, image, gamma=None, color_mode=None, channel=None):
+        self.image = image
+        self.gamma = image.gamma if gamma is None else gamma
+        self.color_mode = color_mode or image.color_mode
+        # grayscale images have a single channel, shown whichever one is asked for
+        self.channel = channel if image.raw.ndim == 3 else None
+
+    def convert_gamma(self, gamma):
+        return Render(self.image, gamma, self.color_mode, self.channel)
+
+    def select(self, color_mode, channel=None):
+        """Views the image in `color_mode`, only `channel` of it if that is not None."""
+        return Render(self.image, self.gamma, color_mode, channel)
+
+    @property
+    def key(self):
+        image = self.image
+        return image.family.id, image.gamma, ("display", self.gamma, self.color_mode, self.channel)
+
+    @property
+    def shape(self):
+        raw = self.image.raw
+        return raw.shape[:2] if raw.ndim == 2 or self.channel is not None else raw.shape[:2] + (3,)
+
+    def evaluate(self, rows):
+        image = self.image
+        strip = image.raw[rows]
+        color_mode = image.color_mode
+        gamma_step = self.gamma != image.gamma
+        if image.max_val is not None and gamma_step and color_mode == "rgb" and strip.dtype.kind in "ui":
+            # the same table Image.convert_gamma looks integer samples up in
+            strip = lookup(gamma_table(image.gamma, self.gamma, image.max_val, float_dtype(strip)), strip)
+            gamma_step = False
+        elif image.max_val is not None:
+            strip = normalize(strip, image.max_val)
+        if gamma_step:
+            strip = apply_gamma(convert_color(strip, color_mode, "rgb"), image.gamma, self.gamma)
+            color_mode = "rgb"
+        # conversions may only reuse the strip once it is a copy and not a view of the image
+        owned = image.max_val is not None or self.gamma != image.gamma
+        strip = convert_color(strip, color_mode, self.color_mode, out=strip if owned else None)
+        if self.channel is not None:
+            strip = strip[:, :, self.channel]
+        scaled = strip * 255
+        return np.round(scaled, out=scaled)
+
+    def render_into(self, out):
+        image = self.image
+        raw = image.raw
+        if (
+            image.max_val is not None
+            and raw.dtype.kind in "ui"
+            and self.color_mode == image.color_mode
+            and (self.gamma == image.gamma or image.color_mode == "rgb")
+        ):
+            samples = raw if self.channel is None else raw[:, :, self.channel]
+            if self.gamma == image.gamma and image.max_val == 255:
+                np.copyto(out, samples, casting="unsafe")
+            else:
+                lookup(display_table(image.gamma, self.gamma, image.max_val), samples, out)
+            return out
+        strip_height = max(1, STRIP_BYTES // max(1, raw[:1].nbytes))
+        for y in range(0, out.shape[0], strip_height):
+            rows = slice(y, y + strip_height)
+            np.copyto(out[rows], self.evaluate(rows), casting="unsafe")
+        return out
+
+    def to_8bit(self):
+        return self.render_into(np.empty(self.shape, np.uint8))
+
+    def pnm(self):
+        def compute():
+            header, _ = pnm_format(self.shape, 255)
+            buffer = bytearray(len(header) + int(np.prod(self.shape)))
+            buffer[: len(header)] = header
+            self.render_into(np.frombuffer(buffer, np.uint8, offset=len(header)).reshape(self.shape))
+            return bytes(buffer)
+
+        return image_cache.get(self.key, compute)
@@ -1,12 +1,8 @@
-import io
 import traceback
 from contextlib import contextmanager
 
-import PySimpleGUI as sg
-
-from .pnm import write_pnm
 from .pnm.exceptions import *
-from .utils import to_8bit
+from .render import Render
 
 
 @contextmanager
@@ -14,6 +10,8 @@ def handle_exception(exit_on_error):
     try:
         yield
     except Exception as exc:
+        import PySimpleGUI as sg
+
         if isinstance(exc, FileOpenError):
             error_text = "Error opening file"
         elif isinstance(exc, UnknownTagError):
@@ -30,6 +28,8 @@ def handle_exception(exit_on_error):
             error_text = f"Unknown chunk type {exc.chunk_name}"
         elif isinstance(exc, ChunkNotFound):
             error_text = f"File does not have {exc.chunk_name} chunk"
+        elif isinstance(exc, ChecksumError):
+            error_text = f"Corrupted chunk {exc.chunk_name} (CRC mismatch)"
         elif isinstance(exc, InvalidContent):
             error_text = f"Invalid content of chunk {exc.chunk_name}: {exc.content}"
         else:
@@ -49,6 +49,8 @@ def handle_exception(exit_on_error):
 
 
 def window_loop(window):
+    import PySimpleGUI as sg
+
     while True:
         event, values = window.read()
         if event in [sg.WINDOW_CLOSED, "Exit", "Cancel"]:
@@ -63,16 +65,19 @@ def open_window(window):
 
 
 def draw_image(graph, image, color_mode, channel):
-    image_data = image.convert_gamma(2.2)[color_mode]
-    if channel != "All":
-        image_data = image_data[:, :, int(channel) - 1]
-    buffer = io.BytesIO()
-    write_pnm(to_8bit(image_data), 255, buffer)
+    render = Render(image).convert_gamma(2.2).select(color_mode, None if channel == "All" else int(channel) - 1)
+    data = render.pnm()
+    # the same view of the same pixels is the same cached bytes object, already on screen
+    if getattr(graph, "drawn", None) is data:
+        return
+    graph.drawn = data
     graph.erase()
-    graph.draw_image(data=buffer.getvalue(), location=(0, 0))
+    graph.draw_image(data=data, location=(0, 0))
 
 
 def require_filename(title, layout):
+    import PySimpleGUI as sg
+
     window = sg.Window(title, layout, modal=True)
     with open_window(window) as evs:
         for event, values in evs:
@@ -0,0 +1,67 @@
+"""Compiles every numba kernel ahead of use: `python -m graphics.warmup`.
+
+The kernels are declared with cache=True, so running this once (at install time, or when
+building an image for batch workers) leaves the machine code in numba's on-disk cache, and
+later processes load it instead of compiling on their first call. Tiny images are pushed
+through the same public paths the viewer and the pipeline take, in both float precisions, so
+the cached signatures are the ones actually used.
+"""
+import io
+from timeit import default_timer
+
+import numpy as np
+
+from .colors import Image, convert_color
+from .dither import algos, blue_noise
+from .png import read_png, write_png
+from .render import Render
+
+
+def warm_png():
+    image = np.arange(4 * 5 * 3, dtype=np.uint8).reshape(4, 5, 3)
+    for filter_type in [None, 0, 1, 2, 3, 4]:
+        file = io.BytesIO()
+        write_png(image, file, 2.2, filter_type=filter_type, indexed=False)
+        file.seek(0)
+        read_png(file)
+
+
+def warm_colors(dtype):
+    image = np.linspace(0, 1, 4 * 5 * 3, dtype=dtype).reshape(4, 5, 3)
+    for mode in ["hsl", "hsv"]:
+        convert_color(convert_color(image, "rgb", mode), mode, "rgb")
+
+
+def warm_gamma():
+    raw = np.arange(4 * 5 * 3, dtype=np.uint8).reshape(4, 5, 3)
+    image = Image(raw, max_val=255)
+    image.convert_gamma(1).data
+    Render(Image(raw, gamma=1, max_val=255)).convert_gamma(2.2).pnm()
+
+
+def warm_dither(dtype):
+    image = np.linspace(0, 1, 4 * 5 * 3, dtype=dtype).reshape(4, 5, 3)
+    palette = np.eye(3)
+    for algo in ["floyd", "ordered"]:
+        algos[algo](image, 1, palette=palette)
+    algos["floyd"](image, 1, parallel=False)
+    algos["floyd"](image, 1, parallel=True)
+    blue_noise()
+
+
+def warm_up():
+    for name, warm, args in [
+        ("png filters", warm_png, ()),
+        ("colors", warm_colors, (np.float32,)),
+        ("colors (float64)", warm_colors, (np.float64,)),
+        ("gamma tables", warm_gamma, ()),
+        ("dithering", warm_dither, (np.float32,)),
+        ("dithering (float64)", warm_dither, (np.float64,)),
+    ]:
+        start = default_timer()
+        warm(*args)
+        print(f"{name:>20} {default_timer() - start:6.2f} s")
+
+
+if __name__ == "__main__":
+    warm_up()
@@ -0,0 +1,4 @@
+import os
+
+# the wavefront and other parallel kernels only show races with several threads, whatever the machine
+os.environ.setdefault("NUMBA_NUM_THREADS", "4")
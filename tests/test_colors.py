@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from graphics.colors import hsl_to_rgb, hsv_to_rgb, lookup, rgb_to_hsl, rgb_to_hsv
+from graphics.pnm import DataError
+from graphics.reference import hsx_conversions, hsx_test_image
+
+
+@pytest.mark.parametrize("name, convert, legacy", hsx_conversions, ids=[c[0] for c in hsx_conversions])
+def test_hsx_matches_legacy(name, convert, legacy):
+    image = hsx_test_image((30, 40, 3))
+    assert np.allclose(convert(image), legacy(image), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("there, back", [(rgb_to_hsl, hsl_to_rgb), (rgb_to_hsv, hsv_to_rgb)])
+def test_hsx_round_trip(there, back):
+    image = hsx_test_image((30, 40, 3))
+    assert np.allclose(back(there(image)), image, rtol=0, atol=1e-12)
+
+
+def test_hsx_in_place():
+    image = hsx_test_image((30, 40, 3))
+    expected = rgb_to_hsl(image)
+    assert rgb_to_hsl(image, out=image) is image
+    assert np.array_equal(image, expected)
+
+
+@pytest.mark.parametrize("dtype", ["u1", ">u2", "<u2", "i4"])
+def test_lookup_out_of_range(dtype):
+    table = np.arange(16, dtype=np.float32)
+    samples = np.array([[1, 2, 200, 3, 4]], dtype)
+    with pytest.raises(DataError):
+        lookup(table, samples)
+    assert np.array_equal(lookup(table, samples % 16), samples % 16)
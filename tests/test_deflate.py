@@ -0,0 +1,43 @@
+import io
+import zlib
+
+import numpy as np
+import pytest
+
+from graphics.png import read_png, write_png
+from graphics.png.deflate import ADLER_BASE, ParallelCompressor, adler32_combine
+
+rng = np.random.default_rng(0)
+# noise compresses poorly and runs well, so blocks get both literals and matches into the previous block
+data = (rng.integers(0, 4, 300_000, np.uint8) * np.repeat(rng.integers(0, 2, 3000, np.uint8), 100)).tobytes()
+
+
+@pytest.mark.parametrize("split", [0, 1, 1000, ADLER_BASE, 2 * ADLER_BASE + 7, len(data)])
+def test_adler32_combine(split):
+    first, second = data[:split], data[split:]
+    combined = adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+    assert combined == zlib.adler32(data)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+@pytest.mark.parametrize("block_size", [1 << 12, 50_000, 1 << 20])
+@pytest.mark.parametrize("piece", [777, 1 << 16])
+def test_parallel_compressor(workers, block_size, piece):
+    compressor = ParallelCompressor(6, workers, block_size)
+    stream = b"".join(compressor.compress(data[i : i + piece]) for i in range(0, len(data), piece))
+    stream += compressor.flush()
+    # zlib checks the Adler-32 at the end of the stream too
+    assert zlib.decompress(stream) == data
+
+
+def test_parallel_compressor_empty():
+    compressor = ParallelCompressor(workers=2)
+    assert zlib.decompress(compressor.compress(b"") + compressor.flush()) == b""
+
+
+def test_png_workers():
+    image = rng.integers(0, 256, (120, 90, 3), np.uint8)
+    file = io.BytesIO()
+    write_png(image, file, 2.2, indexed=False, workers=3, block_size=4096)
+    file.seek(0)
+    assert np.array_equal(read_png(file)[0], image)
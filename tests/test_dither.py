@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from graphics.dither import algos
+from graphics.jit import get_num_threads
+
+diffusion = ["floyd", "atkinson", "jarvis", "stucki", "burkes", "sierra", "two_row_sierra", "sierra_lite"]
+# wide enough for several column blocks of the wavefront to be in flight at once
+image = np.random.default_rng(0).random((45, 333, 3)).astype(np.float32)
+palette = np.random.default_rng(1).random((20, 3))
+
+
+def in_strips(dither, heights, **options):
+    state = {}
+    strips, top = [], 0
+    for height in heights:
+        strips.append(dither(image[top : top + height], 1, state=state, **options))
+        top += height
+    return np.concatenate(strips)
+
+
+@pytest.mark.parametrize("name", diffusion)
+@pytest.mark.parametrize("bitness, options", [(1, {}), (3, {}), (1, {"palette": palette})])
+def test_wavefront_matches_serial(name, bitness, options):
+    assert get_num_threads() > 1
+    serial = algos[name](image, bitness, parallel=False, **options)
+    assert np.array_equal(algos[name](image, bitness, parallel=True, **options), serial)
+
+
+@pytest.mark.parametrize("name", diffusion)
+@pytest.mark.parametrize("options", [{"parallel": False}, {"parallel": True}, {"serpentine": True}])
+def test_strips_match_whole_image(name, options):
+    whole = algos[name](image, 1, **options)
+    assert np.array_equal(in_strips(algos[name], [1, 7, 2, 20, 15], **options), whole)
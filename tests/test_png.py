@@ -0,0 +1,107 @@
+import io
+import zlib
+
+import numpy as np
+import pytest
+
+from graphics.png import PngReader, write_png
+from graphics.png.filters import filter
+from graphics.png.png import ADAM7, ADAM7_GRID, INFLATE_CHUNK, PNG_SIGNATURE, Chunk, ChunkType, Inflater
+from graphics.pnm.exceptions import ChecksumError, DataError, InvalidContent, UnknownChunkType
+
+rng = np.random.default_rng(0)
+
+
+def round_trip(image, **options):
+    file = io.BytesIO()
+    write_png(image, file, 2.2, **options)
+    file.seek(0)
+    return PngReader(file).read()
+
+
+@pytest.mark.parametrize("idat_size", [1 << 30, 8192, 7])
+@pytest.mark.parametrize("image", [np.zeros((300, 500), np.uint8), rng.integers(0, 256, (60, 70, 3), np.uint8)])
+def test_round_trip(image, idat_size):
+    assert np.array_equal(round_trip(image, idat_size=idat_size, indexed=False), image)
+
+
+def test_inflater_holds_one_request():
+    # a flat image inflates a thousandfold, all of it from a single slice of input
+    stride = 4001
+    inflater = Inflater([zlib.compress(bytes(stride * 2000))])
+    for _ in range(2000):
+        assert inflater.read(stride) == bytes(stride)
+        assert not inflater.pending
+        assert len(inflater.tail) <= INFLATE_CHUNK
+    with pytest.raises(InvalidContent):
+        inflater.read(1)
+
+
+def interlaced_png(image):
+    """An Adam7 interlaced PNG of `image`, which the writer does not produce."""
+    height, width = image.shape[:2]
+    color_type = 2 if image.ndim == 3 else 0
+    ihdr = width.to_bytes(4, "big") + height.to_bytes(4, "big") + bytes([8, color_type, 0, 0, 1])
+    passes = [filter(image[y0::dy, x0::dx]).tobytes() for x0, y0, dx, dy in ADAM7 if x0 < width and y0 < height]
+    chunks = [Chunk(ChunkType.IHDR, ihdr), Chunk(ChunkType.IDAT, zlib.compress(b"".join(passes)))]
+    chunks.append(Chunk(ChunkType.IEND, b""))
+    return io.BytesIO(PNG_SIGNATURE + b"".join(chunk.create_binary() for chunk in chunks))
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (3, 5), (9, 2), (17, 29, 3), (64, 40, 3)])
+def test_interlaced(shape):
+    image = rng.integers(0, 256, shape, np.uint8)
+    assert np.array_equal(PngReader(interlaced_png(image)).read(), image)
+    strips = list(PngReader(interlaced_png(image)).strips(4))
+    assert np.array_equal(np.concatenate(strips), image)
+
+
+def test_progressive():
+    image = rng.integers(0, 256, (21, 13, 3), np.uint8)
+    previews = list(PngReader(interlaced_png(image)).progressive())
+    assert len(previews) == len(ADAM7_GRID)
+    for preview, (dy, dx) in zip(previews, ADAM7_GRID):
+        assert preview.shape == image.shape
+        # every pixel repeats the decoded pixel at the top left of its block of the grid
+        rows, columns = np.arange(21) // dy * dy, np.arange(13) // dx * dx
+        assert np.array_equal(preview, image[rows][:, columns])
+    assert np.array_equal(previews[-1], image)
+
+
+def png_file(tmp_path, data, use_mmap):
+    if not use_mmap:
+        return io.BytesIO(data)
+    path = tmp_path / "image.png"
+    path.write_bytes(data)
+    return open(path, "rb")
+
+
+def png_bytes():
+    file = io.BytesIO()
+    write_png(rng.integers(0, 256, (8, 9, 3), np.uint8), file, 2.2, indexed=False)
+    return bytearray(file.getvalue())
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_corrupted_chunk_name(tmp_path, use_mmap):
+    data = png_bytes()
+    data[len(PNG_SIGNATURE) + 4] = 0xC9  # the I of IHDR
+    with png_file(tmp_path, data, use_mmap) as file, pytest.raises(ChecksumError):
+        PngReader(file, use_mmap=use_mmap)
+    with png_file(tmp_path, data, use_mmap) as file, pytest.raises(UnknownChunkType):
+        PngReader(file, verify_crc=False, use_mmap=use_mmap)
+
+
+@pytest.mark.parametrize("verify_crc", [False, True])
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_truncated_chunk(tmp_path, verify_crc, use_mmap):
+    data = png_bytes()
+    # the IHDR chunk claims more data than the file has
+    data[len(PNG_SIGNATURE) : len(PNG_SIGNATURE) + 4] = (1 << 20).to_bytes(4, "big")
+    with png_file(tmp_path, data, use_mmap) as file, pytest.raises(InvalidContent):
+        PngReader(file, verify_crc=verify_crc, use_mmap=use_mmap)
+
+
+def test_unknown_filter_type():
+    with pytest.raises(DataError):
+        write_png(np.zeros((2, 3), np.uint8), io.BytesIO(), 2.2, filter_type=5)
@@ -0,0 +1,46 @@
+import io
+
+import numpy as np
+import pytest
+
+from graphics.pnm import FormatError, iter_pnm, read_pnm, write_pnm
+
+
+@pytest.mark.parametrize("read", [read_pnm, lambda file: next(iter_pnm(file))])
+def test_samples_above_max_val(read):
+    with pytest.raises(FormatError):
+        read(io.BytesIO(b"P5 5 1 15\n" + bytes([1, 2, 200, 3, 4])))
+
+
+def write(image, max_val, plain=False):
+    file = io.BytesIO()
+    write_pnm(image, max_val, file, plain)
+    return file.getvalue()
+
+
+@pytest.mark.parametrize("shape", [(13, 17), (13, 17, 3)])
+@pytest.mark.parametrize("max_val", [255, 1000])
+@pytest.mark.parametrize("plain", [False, True])
+def test_round_trip(shape, max_val, plain):
+    image = np.random.default_rng(0).integers(0, max_val + 1, shape, "u1" if max_val <= 255 else "u2")
+    read, read_max_val = read_pnm(io.BytesIO(write(image, max_val, plain)))
+    assert read_max_val == max_val
+    assert np.array_equal(read, image)
+
+
+@pytest.mark.parametrize("body", [b"\0" * 14, b"\0" * 16])
+def test_body_length(body):
+    with pytest.raises(FormatError, match="image data length"):
+        read_pnm(io.BytesIO(b"P5 5 3 255\n" + body))
+
+
+class Trickle(io.BytesIO):
+    def read1(self, size=-1):
+        return super().read1(3)
+
+
+def test_plain_in_blocks():
+    # blocks end inside samples and comments, which have to be carried over to the next one
+    text = b"P2 # a comment\n4 4\n# another one\n15\n0 1 2 3 # 4 5\n 4 5 6 7\n8 9 10\t11\r\n12 13 14 15\n"
+    image, _ = read_pnm(Trickle(text))
+    assert np.array_equal(image, np.arange(16).reshape(4, 4))
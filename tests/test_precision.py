@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from graphics import utils
+from graphics.colors import Image
+from graphics.dither import algos
+from graphics.reference import precision_stages
+from graphics.utils import normalize, set_precision, to_8bit
+
+MAX_VAL = 65535
+raw = np.random.default_rng(0).integers(0, MAX_VAL + 1, (30, 40, 3), dtype=np.uint16)
+
+
+def in_precision(dtype, f, *args):
+    previous = utils.precision
+    set_precision(dtype)
+    try:
+        return f(*args)
+    finally:
+        set_precision(previous)
+
+
+@pytest.fixture(scope="module")
+def single():
+    return in_precision(np.float32, precision_stages, raw, MAX_VAL)
+
+
+@pytest.fixture(scope="module")
+def double():
+    return in_precision(np.float64, precision_stages, raw, MAX_VAL)
+
+
+def test_default_is_float32():
+    assert utils.precision == np.float32
+    assert Image(raw, max_val=MAX_VAL).data.dtype == np.float32
+
+
+@pytest.mark.parametrize("stage", list(precision_stages(raw[:1, :1], MAX_VAL)))
+def test_stage_error_against_float64(single, double, stage):
+    # float32 has a 24-bit mantissa: every stage stays far below one step of 16-bit samples
+    assert single[stage].dtype == np.float32
+    assert double[stage].dtype == np.float64
+    error = np.abs(single[stage] - double[stage]).max()
+    # dithering rounds, so a sample right on a threshold may flip by one level
+    assert error <= (1 / 3 if stage == "ordered dither" else 1e-5)
+
+
+def test_8bit_output(single, double):
+    single_8bit, double_8bit = to_8bit(single["normalize"]), to_8bit(double["normalize"])
+    assert np.abs(single_8bit.astype(int) - double_8bit).max() <= 1
+    # the integer path rounds exactly like float64
+    assert np.array_equal(to_8bit(raw, MAX_VAL), double_8bit)
+
+
+@pytest.mark.parametrize("algo", ["ordered", "blue_noise", "random_nosync", "floyd", "atkinson"])
+def test_dither_keeps_precision(algo):
+    image = normalize(raw, MAX_VAL)
+    assert algos[algo](image, 2).dtype == np.float32
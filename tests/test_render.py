@@ -0,0 +1,86 @@
+import io
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from graphics.colors import SRGB, Image, color_modes
+from graphics.png import PngReader, write_png
+from graphics.pnm import read_pnm, write_pnm
+from graphics.render import Render
+from graphics.utils import to_8bit
+
+BABOON = Path(__file__).parent.parent / "img" / "baboon.pgm"
+
+rng = np.random.default_rng(0)
+raw = rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)
+
+
+def legacy_display(image, color_mode, channel):
+    # the draw path before Render: every step materialized
+    data = image.convert_gamma(2.2)[color_mode]
+    if channel is not None:
+        data = data[:, :, channel]
+    buffer = io.BytesIO()
+    write_pnm(to_8bit(data), 255, buffer)
+    return buffer.getvalue()
+
+
+def display(image, color_mode, channel):
+    return Render(image).convert_gamma(2.2).select(color_mode, channel).pnm()
+
+
+def gray_png(image, gamma=2.2):
+    file = io.BytesIO()
+    write_png(image, file, gamma)
+    file.seek(0)
+    png = PngReader(file)
+    return Image(png.read(), gamma=png.gamma, max_val=255)
+
+
+@pytest.mark.parametrize(
+    "make_image",
+    [
+        lambda: Image(raw, max_val=255),
+        lambda: Image(raw, gamma=1.0, max_val=255),
+        lambda: Image(raw, gamma=SRGB, max_val=255),
+        lambda: Image(raw, "hsl", gamma=1.0, max_val=255),
+        lambda: Image(raw.astype(np.float32) / 255, "ycocg"),
+        lambda: Image(raw / 255, gamma=1.0),
+        # float hsl, as the viewer makes after drawing a line in hsl mode
+        lambda: Image(raw.astype(np.float32) / 255, "hsl"),
+        lambda: Image(raw.astype(np.float32) / 255, "hsv", gamma=1.0),
+    ],
+)
+def test_color_matches_legacy(make_image):
+    image = make_image()
+    for color_mode in color_modes:
+        for channel in [None, 0, 1, 2]:
+            assert display(image, color_mode, channel) == legacy_display(image, color_mode, channel)
+
+
+@pytest.mark.parametrize("gamma", [2.2, 1.0])
+def test_pgm_matches_legacy(gamma):
+    with open(BABOON, "rb") as file:
+        data, max_val = read_pnm(file)
+    image = Image(data, gamma=gamma, max_val=max_val)
+    expected = legacy_display(image, "rgb", None)
+    assert expected.startswith(b"P5")
+    assert display(image, "rgb", None) == expected
+    # there is only one channel to pick
+    assert display(image, "rgb", 1) == expected
+
+
+@pytest.mark.parametrize("samples", [np.full((7, 17), 128, np.uint8), raw[:, :, 0]])
+def test_gray_png_matches_legacy(samples):
+    image = gray_png(samples)
+    assert display(image, "rgb", None) == legacy_display(image, "rgb", None)
+
+
+def test_own_color_mode_is_untouched():
+    # grays have no meaningful hue, which a detour through rgb would zero
+    data = np.stack([np.full((4, 5), 0.7), np.zeros((4, 5)), np.linspace(0, 1, 20).reshape(4, 5)], axis=-1)
+    image = Image(data, "hsl", gamma=1.0)
+    expected = to_8bit(data)
+    rendered = np.frombuffer(Render(image).pnm(), np.uint8)[-expected.size :].reshape(expected.shape)
+    assert np.array_equal(rendered, expected)